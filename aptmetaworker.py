@@ -16,6 +16,7 @@ from boto.s3.key import Key
 from boto.s3.bucket import Bucket
 from datetime import date, timedelta
 from s3uploadobj import S3UploadObject
+import connpool
 import urllib3
 import boto.exception
 import logging
@@ -26,7 +27,7 @@ import os
 
 class MetaS3Worker(threading.Thread):
 
-	def __init__(self, queue, dest_bucket, logger, creds, error, max_retry=3):
+	def __init__(self, queue, dest_bucket, logger, creds, error, max_retry=3, inventory=None):
 		threading.Thread.__init__(self)
 		self.setDaemon(True)
 		self.queue = queue
@@ -36,27 +37,16 @@ class MetaS3Worker(threading.Thread):
 		self.bucket = None
 		self.max_retry = max_retry		# How many times to try and fetch the file
 		self.rollback_md5 = {} 		# Used to store keys/md5 for rollback
+		self.inventory = inventory		# BucketInventory to record uploads, flips and deletes in
 
         # Hopefully we re-use the same logger here
 		self.logger = logging.getLogger(logger)
 		self.logger.info("Worker thread created")
 
 		try:
-			self.conn = S3Connection(creds[0], creds[1])
-
-			if self.conn is None:
-				raise Exception("S3_NO_CONN", "S3 connection failed")
-
-			else:
-				self.logger.debug("Connection to S3 established")
-
-			self.bucket = self.conn.get_bucket( self.dest_bucket)
-
-			if self.bucket is None:
-				raise Exception("NO_BUCKET", "Unable to get bucket %s" % self.dest_bucket )
-
-			else:
-				self.logger.debug("Fetched bucket %s" % self.dest_bucket )
+			'''the bucket is validated once here, the worker thread makes its own connection'''
+			connpool.s3_bucket( creds, self.dest_bucket )
+			self.logger.debug("Fetched bucket %s" % self.dest_bucket )
 
 		except Exception, e:
 			self.logger.error("Exception during establishment of S3 Connection")
@@ -83,8 +73,7 @@ class MetaS3Worker(threading.Thread):
 			self.logger.debug("backing up %s" % ( k.get_value('key_name') ) )
 			file_success = False
 			file_try = 0
-			bucket = self.conn.get_bucket( self.dest_bucket )
-			key = bucket.get_key( k.get_value('key_name') )
+			key = self.bucket.get_key( k.get_value('key_name') )
 
 			'''Only backup existing keys'''
 			try:
@@ -117,6 +106,10 @@ class MetaS3Worker(threading.Thread):
 
 						key.copy( self.dest_bucket, "%s-%s" % ( k.get_value('key_name'), backup_ext ), metadata=meta)
 						key.copy( self.dest_bucket, "%s-latest" % k.get_value('key_name'), metadata=meta )
+
+						if self.inventory:
+							for backup in "%s-%s" % ( k.get_value('key_name'), backup_ext ), "%s-latest" % k.get_value('key_name'):
+								self.inventory.record_upload( backup, key.etag, key.size, purge_date.toordinal() )
 						self.logger.debug("Attempt [ %s/%s ] Backed-up %s as %s-[%s,rollback]" % ( file_try,
 							self.max_retry, k.get_value('key_name'), k.get_value('key_name'), backup_ext ))
 
@@ -187,6 +180,9 @@ class MetaS3Worker(threading.Thread):
 					key.set_contents_from_filename(k.get_value('cache_file'), md5=k.get_md5())
 					file_success = True
 
+					if self.inventory:
+						self.inventory.record_upload( key.name, k.get_value('md5'), os.path.getsize(k.get_value('cache_file')) )
+
 				except Exception, e:
 					self.logger.info("Attempt [ %s/%s ] Failed upload of %s\n%s\n%s" % ( file_try, self.max_retry, k.get_value('key_name'), e, k.dump() ))
 
@@ -247,6 +243,9 @@ class MetaS3Worker(threading.Thread):
 						flipped.append("%s" % key_name )
 						success = True
 
+						if self.inventory:
+							self.inventory.record_upload( key_name, k.get_value('md5') )
+
 				except Exception, e:
 
 					if tries >= max_tries:
@@ -281,6 +280,9 @@ class MetaS3Worker(threading.Thread):
 					self.logger.debug("Removed %s" % key.name )
 					key.delete()
 
+					if self.inventory:
+						self.inventory.record_delete( key.name )
+
 			except Exception, e:
 				self.logger.warn("Non-critical error: unable to remove staging key %s\n%s" % ( key.name, e ) )
 				pass
@@ -346,6 +348,7 @@ class MetaS3Worker(threading.Thread):
 		"""
 
 		self.logger.debug("Found %s APT META Data batches for processing %s" % ( self.queue.qsize(), self.queue.empty() ))
+		self.bucket = connpool.s3_bucket( self.creds, self.dest_bucket )
 
 		while not self.queue.empty():
 
@@ -17,6 +17,7 @@ from time import strftime
 from datetime import date, timedelta
 from s3uploadobj import S3UploadObject
 from s3deleteworker import S3DeleteWorker
+from metaparser import COMPRESSION_PREFERENCE, split_compression
 
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
@@ -37,13 +38,25 @@ import sys
 import tempfile
 import time
 import threading
-import urllib3
+import connpool
+
+
+def variant_rank(ext):
+	"""
+	Sort key for compressed variants of an index, cheapest to fetch and parse first
+	"""
+	if ext in COMPRESSION_PREFERENCE:
+		return COMPRESSION_PREFERENCE.index(ext)
+
+	return len(COMPRESSION_PREFERENCE)
 
 
 class APTReleaseParser():
 
 	def __init__(self, logger, tempdir=None):
 		self.tempdir = tempdir
+		self.listed = {}	# ( md5, size ) of every file in the MD5Sum list of the Release
+		self.md5 = None		# MD5 of the Release file parsed
 
 		# Hopefully we re-use the same logger here
 		self.logger = logging.getLogger(logger)
@@ -58,7 +71,7 @@ class APTReleaseParser():
 		excluded_re = re.compile('.*debian-installer.*|.*(Sources|Packages)$|.*source.*|.*sources.*')
 
 		try:
-			http = urllib3.PoolManager()
+			http = connpool.http()
 			success = False
 			tries = 0
 			max_try = 3
@@ -93,10 +106,12 @@ class APTReleaseParser():
 					self.logger.critical("Failed fetch on %s" % key_name)
 
 				meta.md5_cache_file()
+				self.md5 = meta.get_value('md5')
 				queue.put(meta)
 
 				started_md5 = False
 				count = 0
+				variants = {}
 				for line in resp.data.splitlines():
 
 					if not started_md5:
@@ -106,6 +121,7 @@ class APTReleaseParser():
 
 					elif not stop_md5_re.match( line ):
 						md5, size, kname = line.split()
+						self.listed[kname] = ( md5, size )
 
 						if match_re.match( kname ) and not excluded_re.match( kname ):
 							anon = S3UploadObject()
@@ -114,12 +130,23 @@ class APTReleaseParser():
 							anon.set_value('temp_name', key_name.replace('/','_') )
 							anon.set_value('size', size)
 							anon.set_value('remote_md5', md5)
-							queue.put(anon)
-							count += 1
+
+							'''group the compressed variants of each index'''
+							base, ext = split_compression(kname)
+							variants.setdefault(base, []).append(( ext, anon ))
 
 					elif stop_md5_re.match(line):
 						break
 
+				'''every variant is uploaded, but only the cheapest one is parsed: the
+					others ride along with it, so the worker can fall back to them'''
+				for base in sorted(variants):
+					candidates = [ anon for ext, anon in sorted(variants[base], key=lambda v: variant_rank(v[0])) ]
+					candidates[0].set_value('parse', True)
+					candidates[0].set_value('variants', candidates[1:])
+					queue.put(candidates[0])
+					count += len(candidates)
+
 				self.logger.info("%s has MD5 of %s" % ( key_name, meta.get_value('md5')))
 				self.logger.info("Found %s meta-items in %s" % ( count, key_name ))
 
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import json
+import os
+import resource
+import subprocess
+import sys
+
+"""
+Helpers shared by the benchmark scripts in bench/. Each case of a benchmark runs in a
+child process of its own, so its peak RSS is not mixed up with the other cases, or
+with the set up done by the parent. The child prints its results as one JSON line.
+"""
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if REPO not in sys.path:
+	sys.path.insert(0, REPO)
+
+
+def peak_rss_mb():
+	"""
+	Peak RSS of this process in MB (ru_maxrss is in KB on Linux)
+	"""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def report(**results):
+	"""
+	Prints the results of a child, with its peak RSS
+	"""
+	results['rss_mb'] = round(peak_rss_mb(), 1)
+	print json.dumps(results)
+	sys.stdout.flush()
+
+
+def run_case(script, *args):
+	"""
+	Runs script with args in a child process, returns the dict it reported
+	"""
+	out = subprocess.check_output([ sys.executable, script ] + [ str(a) for a in args ])
+	return json.loads(out.strip().splitlines()[-1])
+
+
+def table(columns, rows):
+	"""
+	Prints rows of dicts as a table of columns
+	"""
+	widths = [ max([ len(str(c)) ] + [ len(str(r.get(c, ''))) for r in rows ]) for c in columns ]
+	print "  ".join([ str(c).ljust(w) for c, w in zip(columns, widths) ])
+
+	for r in rows:
+		print "  ".join([ str(r.get(c, '')).ljust(w) for c, w in zip(columns, widths) ])
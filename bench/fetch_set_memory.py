@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import benchlib
+import copy
+import cPickle as pickle
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+"""
+Peak RSS and time of a fetch set going through the pipeline, with the __slots__
+S3UploadObject passed along by reference, and with the dict based object it replaced
+deep-copied at each step as before (into the pickle, out of it, and into the fetch
+queue). Each case runs in a process of its own.
+
+	bench/fetch_set_memory.py [items]		(default 500000)
+"""
+
+ITEMS = 500000
+
+
+class DictUploadObject():
+	"""
+	The S3UploadObject before __slots__: every value in a per-instance dict
+	"""
+
+	def __init__(self, name=None, cache_file=None, remote_url=None, md5=None, md5_encoded=None,
+			remote_md5=None, remote_md5_encoded=None, size=None, temp_name=None, key_name=None, content_type=None):
+		self.obj = {}
+		self.obj['name'] = name
+		self.obj['key_name'] = key_name
+		self.obj['temp_name'] = temp_name
+		self.obj['cache_file'] = cache_file
+		self.obj['remote_url'] = remote_url
+		self.obj['md5'] = md5
+		self.obj['md5_encoded'] = md5_encoded
+		self.obj['remote_md5'] = remote_md5
+		self.obj['remote_md5_encoded'] = remote_md5_encoded
+		self.obj['size'] = size
+		self.obj['remote_size'] = size
+		self.obj['Content-Type'] = content_type
+
+	def get_value(self, name):
+		return self.obj.get(name)
+
+	def set_value(self, name, value):
+		self.obj[name] = value
+
+
+def make_items(cls, items):
+	"""
+	items upload objects, set up as parse_pkg does
+	"""
+	for n in range(items):
+		name = "pool/main/p/package%s/package%s_1.%s_amd64.deb" % ( n % 20000, n, n )
+		s3obj = cls()
+		s3obj.set_value("name", name)
+		s3obj.set_value("key_name", "ubuntu/%s" % name)
+		s3obj.set_value("remote_url", "http://archive.ubuntu.com/ubuntu/%s" % name)
+		s3obj.set_value("remote_size", str(1000 + n))
+		s3obj.set_value("remote_md5", hashlib.md5(name).hexdigest())
+		s3obj.set_value("remote_sha256", hashlib.sha256(name).hexdigest())
+		yield s3obj
+
+
+def child(case, items):
+	items = int(items)
+	deep = case == 'dict'
+
+	if deep:
+		cls = DictUploadObject
+	else:
+		from s3uploadobj import S3UploadObject
+		cls = S3UploadObject
+
+	start = time.time()
+	parsed = list(make_items(cls, items))
+	built = time.time() - start
+
+	'''prep_work_queue: the parsed items to the spill'''
+	spill = [ copy.deepcopy(item) if deep else item for item in parsed ]
+	del parsed
+
+	fh, fname = tempfile.mkstemp(prefix="bench-spill-")
+	f = os.fdopen(fh, 'w+b')
+	pickle.dump(spill, f, pickle.HIGHEST_PROTOCOL)
+	f.close()
+	del spill
+
+	'''the diff: the spill read back, and queued for upload'''
+	f = open(fname, 'rb')
+	spill = pickle.load(f)
+	f.close()
+	os.unlink(fname)
+
+	fetch_queue = []
+	for item in spill:
+		if deep:
+			item = copy.deepcopy(copy.deepcopy(item))
+		fetch_queue.append(item)
+	del spill
+
+	benchlib.report(case=case, items=len(fetch_queue), build_s=round(built, 1), total_s=round(time.time() - start, 1))
+
+
+def main():
+	items = int(sys.argv[1]) if len(sys.argv) > 1 else ITEMS
+
+	rows = [ benchlib.run_case(__file__, 'child', case, items) for case in ( 'dict', 'slots' ) ]
+	benchlib.table(( 'case', 'items', 'build_s', 'total_s', 'rss_mb' ), rows)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == 'child':
+		child(*sys.argv[2:])
+	else:
+		main()
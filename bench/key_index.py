@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import benchlib
+import hashlib
+import imp
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+"""
+Diffs a synthetic fetch set against a synthetic bucket listing with each --key_index:
+the sqlite md5s table (get_bucket_meta and calc_pkg_work) and the in-memory
+DigestIndex (get_bucket_index and calc_pkg_work_index). Each runs in a process of its
+own, with the sqlite database in a temporary directory.
+
+	bench/key_index.py [keys]		(default 2000000)
+
+Of the keys in the bucket, 1 in 20 is not in the fetch set (orphaned) and 1 in 20 has
+a new MD5; the fetch set also has keys/20 files that are not in the bucket yet.
+"""
+
+KEYS = 2000000
+
+
+def key_name(n):
+	return "ubuntu/pool/main/p/package%s/package%s_1.%s_amd64.deb" % ( n % 20000, n, n )
+
+
+def etag(n):
+	return hashlib.md5(key_name(n)).hexdigest()
+
+
+def write_fetch_set(fname, keys):
+	from fetchspill import FetchSpill
+	from s3uploadobj import S3UploadObject
+
+	spill = FetchSpill(fname)
+
+	for n in xrange(keys + keys / 20):
+		if n < keys and n % 20 == 1:
+			continue
+
+		s3obj = S3UploadObject()
+		s3obj.set_value("key_name", key_name(n))
+		s3obj.set_value("remote_size", "1000")
+		s3obj.set_value("remote_md5", etag(n) if n % 20 != 2 else hashlib.md5(str(n)).hexdigest())
+		spill.put(s3obj)
+
+	spill.close()
+
+
+class CountingQueue():
+	def __init__(self):
+		self.count = 0
+
+	def put(self, item):
+		self.count += 1
+
+
+def child(case, keys, spill):
+	keys = int(keys)
+	logging.basicConfig(level=logging.WARN)
+
+	mirror = imp.load_source('apt2s3mirror', os.path.join(benchlib.REPO, 'apt2s3mirror'))
+
+	class Parser(mirror.UbuntuAPTParser):
+		def __init__(self):
+			self.dists = [ 'precise' ]
+			self.logger = logging.getLogger('_s3local_')
+
+		def list_bucket(self):
+			for n in xrange(keys):
+				yield key_name(n), etag(n), 1000
+
+	parser = Parser()
+	queue = CountingQueue()
+	db_mb = 0
+
+	start = time.time()
+	if case == 'sqlite':
+		db_name = os.path.join(os.path.dirname(spill), "md5s.sqlite")
+		md5_db = sqlite3.connect(db_name)
+		parser.create_tables(md5_db)
+		parser.get_bucket_meta(md5_db)
+		built = time.time()
+
+		parser.calc_pkg_work([ spill ], queue, md5_db, None)
+		diffed = time.time()
+
+		orphaned = len(list(parser.orphaned_keys(md5_db)))
+		md5_db.close()
+		db_mb = round(os.path.getsize(db_name) / 1048576.0, 1)
+
+	else:
+		index = parser.get_bucket_index()
+		built = time.time()
+
+		parser.calc_pkg_work_index([ spill ], queue, index, None)
+		diffed = time.time()
+
+		orphaned = len(list(parser.index_orphaned_keys(index)))
+
+	benchlib.report(case=case, keys=keys, upload=queue.count, orphaned=orphaned, build_s=round(built - start, 1),
+		diff_s=round(diffed - built, 1), orphans_s=round(time.time() - diffed, 1), db_mb=db_mb)
+
+
+def main():
+	keys = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+
+	rows = []
+	for case in ( 'sqlite', 'memory' ):
+		tempdir = tempfile.mkdtemp(prefix="bench-index-")
+
+		try:
+			spill = os.path.join(tempdir, "spill")
+			write_fetch_set(spill, keys)
+			rows.append(benchlib.run_case(__file__, 'child', case, keys, spill))
+
+		finally:
+			shutil.rmtree(tempdir)
+
+	benchlib.table(( 'case', 'keys', 'upload', 'orphaned', 'build_s', 'diff_s', 'orphans_s', 'rss_mb', 'db_mb' ), rows)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == 'child':
+		child(*sys.argv[2:])
+	else:
+		main()
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import benchlib
+import gzip
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+"""
+Parses a synthetic Packages.gz with the streaming deb822 stanza parser of
+APTParserWorker, and with the regex-per-line parser it replaced, which read the whole
+decompressed file into a list of lines first. Each parser runs in a process of its
+own, so the peak RSS is that of the parse alone.
+
+	bench/parse_packages.py [stanzas]		(default 60000)
+
+The items are counted and dropped rather than queued, so only the parse is measured.
+"""
+
+STANZAS = 60000
+
+DESCRIPTION = "\n".join([ " line %s of the long description of the package, as found in main and universe" % n
+	for n in range(8) ])
+
+
+class CountingQueue():
+	def __init__(self):
+		self.count = 0
+
+	def put(self, item):
+		self.count += 1
+
+
+def write_packages(fname, stanzas):
+	"""
+	Writes stanzas packages, with the fields of a real Packages file, to the gzip file fname
+	"""
+	f = gzip.open(fname, 'wb')
+
+	for n in range(stanzas):
+		name = "package%s" % n
+		digest = hashlib.md5(name).hexdigest()
+		f.write("Package: %s\n" % name)
+		f.write("Priority: optional\nSection: universe/misc\nInstalled-Size: %s\n" % ( n % 5000 ))
+		f.write("Maintainer: Ubuntu Developers <ubuntu-devel-discuss@lists.ubuntu.com>\n")
+		f.write("Architecture: amd64\nVersion: 1.%s-0ubuntu1\n" % n)
+		f.write("Depends: libc6 (>= 2.14), libgcc1 (>= 1:4.1.1), libstdc++6 (>= 4.6)\n")
+		f.write("Filename: pool/universe/%s/%s/%s_1.%s-0ubuntu1_amd64.deb\n" % ( name[0], name, name, n ))
+		f.write("Size: %s\n" % ( 1000 + n ))
+		f.write("MD5sum: %s\n" % digest)
+		f.write("SHA1: %s\n" % hashlib.sha1(name).hexdigest())
+		f.write("SHA256: %s\n" % hashlib.sha256(name).hexdigest())
+		f.write("Description: package number %s\n%s\n" % ( n, DESCRIPTION ))
+		f.write("Description-md5: %s\n\n" % digest)
+
+	f.close()
+
+
+def regex_parse(fname, fetch_queue, dstdir, server):
+	"""
+	The parser before the stanza parser: the decompressed file as a list of lines,
+		matched against a regex per field
+	"""
+	from s3uploadobj import S3UploadObject
+
+	pkg_name = re.compile('^Package:.*')
+	pkg_file = re.compile('^Filename:.*')
+	pkg_md5 = re.compile('^MD5sum:.*')
+	pkg_size = re.compile('^Size:.*')
+
+	currpkg = None
+	currfile = None
+	currsize = None
+
+	f = gzip.open(fname, 'rb')
+	lines = f.read().splitlines()
+	f.close()
+
+	for line in lines:
+		if pkg_name.match( line ):
+			currpkg = str( line.split(' ')[1] ).rstrip()
+
+		elif pkg_file.match( line ) and currpkg is not None:
+			currfile = str( line.split(' ')[1] ).rstrip()
+
+		elif pkg_size.match( line ) and currfile is not None:
+			currsize = str( line.split(' ')[1] ).rstrip()
+
+		elif pkg_md5.match( line ) and currsize is not None:
+			s3obj = S3UploadObject()
+			s3obj.set_value("name", currfile)
+			s3obj.set_value("key_name", "%s/%s" % ( dstdir, currfile ))
+			s3obj.set_value("remote_url", "%s/%s" % ( server, currfile ))
+			s3obj.set_value("remote_size", currsize )
+			s3obj.set_value("remote_md5", str( line.split(' ')[1] ).rstrip() )
+			fetch_queue.put( s3obj )
+
+
+def stanza_parse(fname, fetch_queue, dstdir, server):
+	from metaparser import APTParserWorker
+
+	worker = APTParserWorker('_s3local_', None, fetch_queue, None, os.path.dirname(fname), server, dstdir,
+		threading.Event())
+
+	if worker.parse_pkg(fname, fetch_queue, fname) is False:
+		raise Exception("PARSE", "Failed parse of %s" % fname)
+
+
+def child(parser, fname):
+	logging.basicConfig(level=logging.WARN)
+	sink = CountingQueue()
+
+	start = time.time()
+	{ 'regex': regex_parse, 'stanza': stanza_parse }[parser](fname, sink, 'ubuntu', 'http://archive.ubuntu.com/ubuntu')
+	benchlib.report(parser=parser, items=sink.count, seconds=round(time.time() - start, 2))
+
+
+def main():
+	stanzas = int(sys.argv[1]) if len(sys.argv) > 1 else STANZAS
+	tempdir = tempfile.mkdtemp(prefix="bench-parse-")
+
+	try:
+		fname = os.path.join(tempdir, "Packages.gz")
+		write_packages(fname, stanzas)
+		print "%s stanzas, %.1f MB gzipped" % ( stanzas, os.path.getsize(fname) / 1048576.0 )
+
+		rows = [ benchlib.run_case(__file__, 'child', parser, fname) for parser in ( 'regex', 'stanza' ) ]
+		benchlib.table(( 'parser', 'items', 'seconds', 'rss_mb' ), rows)
+
+	finally:
+		shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == 'child':
+		child(*sys.argv[2:])
+	else:
+		main()
@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import os
+import sys
+
+'''the gevent engine must patch the standard library before it is imported'''
+if sys.argv[1:3] == [ 'child', 'gevent' ]:
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	import greenengine
+	greenengine.patch()
+
+import benchlib
+import BaseHTTPServer
+import hashlib
+import imp
+import logging
+import shutil
+import SimpleHTTPServer
+import SocketServer
+import subprocess
+import tempfile
+import threading
+import time
+
+"""
+Uploads a directory of small pool files with the threads and the gevent transfer
+engines, against a local upstream HTTP server and a local S3 stand-in (HEAD, GET and
+PUT of keys, kept in memory). Both add LATENCY seconds to every request, as a stand-in
+for the round trips to a real mirror and to S3.
+
+	bench/transfer_engines.py [files] [size_kb] [latency]		(default 600 20 0.05)
+
+The servers run in a process of their own, and each engine and worker count in
+another. The gevent cases are skipped when gevent is not installed.
+"""
+
+FILES = 600
+SIZE_KB = 20
+LATENCY = 0.05
+
+CASES = ( ( 'threads', 16 ), ( 'threads', 64 ), ( 'gevent', 16 ), ( 'gevent', 200 ), ( 'gevent', 600 ) )
+
+BUCKET = 'bench'
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	request_queue_size = 1024
+
+
+class Upstream(SimpleHTTPServer.SimpleHTTPRequestHandler):
+	"""
+	The mirror: the files of the current directory
+	"""
+	protocol_version = 'HTTP/1.1'
+	latency = LATENCY
+
+	def do_GET(self):
+		time.sleep(self.latency)
+		SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+	def log_message(self, *args):
+		pass
+
+
+class S3StandIn(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	Just enough of S3 for the upload workers, with path style bucket names
+	"""
+	protocol_version = 'HTTP/1.1'
+	latency = LATENCY
+	store = {}
+
+	def log_message(self, *args):
+		pass
+
+	def reply(self, status, body='', etag=None):
+		self.send_response(status)
+		if etag:
+			self.send_header('ETag', '"%s"' % etag)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_HEAD(self):
+		time.sleep(self.latency)
+		path = self.path.split('?')[0]
+
+		if path.rstrip('/').count('/') < 2:
+			'''the bucket'''
+			self.reply(200)
+
+		elif path in self.store:
+			self.send_response(200)
+			self.send_header('ETag', '"%s"' % hashlib.md5(self.store[path]).hexdigest())
+			self.send_header('Content-Length', str(len(self.store[path])))
+			self.end_headers()
+
+		else:
+			self.reply(404)
+
+	def do_GET(self):
+		time.sleep(self.latency)
+		self.reply(200, '<?xml version="1.0"?><ListBucketResult><Name>%s</Name>'
+			'<IsTruncated>false</IsTruncated></ListBucketResult>' % BUCKET)
+
+	def do_PUT(self):
+		data = self.rfile.read(int(self.headers['Content-Length']))
+		time.sleep(self.latency)
+		self.store[self.path.split('?')[0]] = data
+		self.reply(200, etag=hashlib.md5(data).hexdigest())
+
+
+def serve(files_dir, latency):
+	"""
+	Runs the upstream and S3 servers, and prints their ports
+	"""
+	Upstream.latency = S3StandIn.latency = float(latency)
+	os.chdir(files_dir)
+
+	servers = [ Server(( '127.0.0.1', 0 ), handler) for handler in ( Upstream, S3StandIn ) ]
+	for server in servers:
+		t = threading.Thread(target=server.serve_forever)
+		t.daemon = True
+		t.start()
+
+	print " ".join([ str(s.server_address[1]) for s in servers ])
+	sys.stdout.flush()
+
+	'''until the parent closes our stdin'''
+	sys.stdin.read()
+
+
+def child(engine, workers, files_dir, up_port, s3_port):
+	import connpool
+	from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+
+	workers = int(workers)
+	logging.basicConfig(level=logging.WARN)
+
+	def s3_connection(creds):
+		state = connpool.thread_state()
+		conn = state.conns.get(creds[0])
+
+		if conn is None:
+			conn = S3Connection(creds[0], creds[1], host='127.0.0.1', port=int(s3_port), is_secure=False,
+				calling_format=OrdinaryCallingFormat())
+			state.conns[creds[0]] = conn
+
+		return conn
+
+	connpool.s3_connection = s3_connection
+	connpool.configure_http(per_host=workers)
+
+	mirror = imp.load_source('apt2s3mirror', os.path.join(benchlib.REPO, 'apt2s3mirror'))
+
+	class Parser(mirror.UbuntuAPTParser):
+		def __init__(self):
+			self.destination = BUCKET
+			self.creds = ( 'access', 'secret' )
+			self.inventory = None
+			self.download_workers = 0
+			self.download_cache = None
+			self.mirrors = None
+			self.adaptive = False
+			self.paranoid = False
+			self.spool_pool = None
+			self.logger = logging.getLogger('_s3local_')
+
+	queue = mirror.Queue.Queue()
+	names = sorted(os.listdir(files_dir))
+
+	for name in names:
+		data = open(os.path.join(files_dir, name), 'rb').read()
+		s3obj = mirror.S3UploadObject(key_name="%s-%s/%s" % ( engine, workers, name ),
+			remote_url="http://127.0.0.1:%s/%s" % ( up_port, name ), remote_md5=hashlib.md5(data).hexdigest())
+		s3obj.set_value('remote_size', str(len(data)))
+		s3obj.set_value('remote_sha256', hashlib.sha256(data).hexdigest())
+		queue.put(s3obj)
+
+	parser = Parser()
+	start = time.time()
+	worker_list, error, populated = parser.upload(queue, "files", workers=workers)
+	populated.set()
+	parser.upload_wait(worker_list, error, populated, queue)
+
+	benchlib.report(engine=engine, workers=workers, files=len(names), seconds=round(time.time() - start, 1),
+		error=error.is_set())
+
+
+def main():
+	files = int(sys.argv[1]) if len(sys.argv) > 1 else FILES
+	size = int(sys.argv[2]) if len(sys.argv) > 2 else SIZE_KB
+	latency = float(sys.argv[3]) if len(sys.argv) > 3 else LATENCY
+
+	try:
+		imp.find_module('gevent')
+		cases = CASES
+	except ImportError:
+		print "gevent is not installed, only the threads engine is run"
+		cases = [ c for c in CASES if c[0] != 'gevent' ]
+
+	files_dir = tempfile.mkdtemp(prefix="bench-files-")
+	servers = None
+
+	try:
+		for n in range(files):
+			f = open(os.path.join(files_dir, "package%s_1.0_all.deb" % n), 'wb')
+			f.write(os.urandom(size * 1024))
+			f.close()
+
+		servers = subprocess.Popen([ sys.executable, __file__, 'serve', files_dir, str(latency) ],
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		up_port, s3_port = servers.stdout.readline().split()
+		print "%s files of %s KB, %.0f ms latency per request" % ( files, size, latency * 1000 )
+
+		rows = [ benchlib.run_case(__file__, 'child', engine, workers, files_dir, up_port, s3_port)
+			for engine, workers in cases ]
+		benchlib.table(( 'engine', 'workers', 'files', 'seconds', 'rss_mb', 'error' ), rows)
+
+	finally:
+		if servers is not None:
+			servers.stdin.close()
+			servers.wait()
+		shutil.rmtree(files_dir)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+		serve(*sys.argv[2:])
+	elif len(sys.argv) > 1 and sys.argv[1] == 'child':
+		child(*sys.argv[2:])
+	else:
+		main()
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import logging
+import sqlite3
+import threading
+import time
+
+"""
+BucketInventory is a persistent, local copy of a bucket listing: key name, ETag, size
+and delete tag. The mirror records its own uploads, flips, tags and deletes in it, so
+an incremental sync can read the bucket state from it rather than listing the bucket.
+
+The inventory is marked dirty while a run has it open. An inventory that was not closed
+cleanly, or that has not been fully re-listed for a while, needs reconciling against
+a real listing before it is trusted.
+"""
+
+class BucketInventory():
+
+	def __init__(self, logger, fname):
+		self.fname = fname
+		self.lock = threading.Lock()
+		self.pending = 0
+
+		# Hopefully we re-use the same logger here
+		self.logger = logging.getLogger(logger)
+
+		self.db = sqlite3.connect(fname, check_same_thread=False)
+		self.db.text_factory = str
+		c = self.db.cursor()
+		c.execute("PRAGMA journal_mode=WAL")		# so listing readers do not block the workers
+		c.execute('''CREATE TABLE IF NOT EXISTS inventory (key_name TEXT PRIMARY KEY, etag TEXT, size INTEGER,
+			delete_ordinal INTEGER, listed INTEGER)''')
+		c.execute('''CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT)''')
+
+		self.was_new = self.get_state('clean') is None
+		self.was_clean = self.get_state('clean') == '1'
+		self.set_state('clean', '0')
+		self.db.commit()
+		c.close()
+
+		self.logger.info("Using %s as bucket inventory" % fname)
+
+	def get_state(self, name):
+		row = self.db.execute("select value from state where name = ?", ( name, )).fetchone()
+
+		if row:
+			return row[0]
+
+		return None
+
+	def set_state(self, name, value):
+		self.db.execute("insert or replace into state values (?, ?)", ( name, value ))
+
+	def needs_reconcile(self, max_age_days):
+		"""
+		True if the inventory can not be trusted without a full listing
+		"""
+		if self.was_new:
+			self.logger.info("Bucket inventory is new")
+			return True
+
+		if not self.was_clean:
+			self.logger.info("Bucket inventory was not closed cleanly")
+			return True
+
+		last = self.get_state('reconciled')
+		if last is None or time.time() - float(last) > max_age_days * 86400:
+			self.logger.info("Bucket inventory is due for reconciliation")
+			return True
+
+		return False
+
+	def reconcile(self, prefix, keys, full=False):
+		"""
+		Replaces the inventory under prefix with keys, an iterator of
+			( name, etag, size ) from a bucket listing. Delete tags of keys
+			that are still listed are preserved
+		"""
+		count = 0
+		upper = prefix + '\xff'
+
+		with self.lock:
+			c = self.db.cursor()
+			c.execute("update inventory set listed = 0 where key_name >= ? and key_name < ?", ( prefix, upper ))
+
+			for name, etag, size in keys:
+				c.execute("update inventory set etag = ?, size = ?, listed = 1 where key_name = ?", ( etag, size, name ))
+
+				if c.rowcount == 0:
+					c.execute("insert into inventory values (?, ?, ?, NULL, 1)", ( name, etag, size ))
+
+				count += 1
+
+			c.execute("delete from inventory where listed = 0 and key_name >= ? and key_name < ?", ( prefix, upper ))
+
+			if full:
+				self.set_state('reconciled', str(time.time()))
+
+			self.db.commit()
+			c.close()
+
+		self.logger.info("Reconciled %s keys under %s" % ( count, prefix ))
+
+	def keys(self, prefix):
+		"""
+		Iterator over ( name, etag, size ) under prefix, in key order. This
+			reads through its own connection, so the inventory can be
+			written to while it is iterated
+		"""
+		with self.lock:
+			self.db.commit()
+			self.pending = 0
+
+		db = sqlite3.connect(self.fname)
+		db.text_factory = str
+		rows = db.execute("select key_name, etag, size from inventory where key_name >= ? and key_name < ? order by key_name",
+			( prefix, prefix + '\xff' ))
+
+		for row in rows:
+			yield row
+
+		db.close()
+
+	def write(self, sql, values):
+		with self.lock:
+			self.db.execute(sql, values)
+			self.pending += 1
+
+			if self.pending >= 1000:
+				self.db.commit()
+				self.pending = 0
+
+	def record_upload(self, name, etag, size=None, delete_ordinal=None):
+		"""
+		Records a key written by the mirror, either uploaded or copied
+		"""
+		self.write("insert or replace into inventory values (?, ?, ?, ?, 1)",
+			( name, etag.replace('"', ''), size, delete_ordinal ))
+
+	def record_tag(self, name, delete_ordinal):
+		self.write("update inventory set delete_ordinal = ? where key_name = ?", ( delete_ordinal, name ))
+
+	def record_delete(self, name):
+		self.write("delete from inventory where key_name = ?", ( name, ))
+
+	def close(self):
+		"""
+		Flushes the inventory and marks it as clean
+		"""
+		with self.lock:
+			self.set_state('clean', '1')
+			self.db.commit()
+			self.db.close()
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+"""
+AdaptiveLimiter sizes the number of transfers in flight while the mirror runs, so
+--workers becomes a ceiling rather than a guess.
+
+The workers take a slot before each transfer and hand it back with the bytes moved and
+the time it took. Once per WINDOW the limiter looks at the window as a whole (AIMD):
+
+	* a SlowDown (or any 503) from S3 halves the slots, at most once per window
+	* if throughput dropped while latency grew well past the best seen, the
+	  extra slots only queue behind each other, so one step is taken off
+	* otherwise, if every slot was in use, one step is added
+
+A transfer takes longer the bigger the file, so the latency is the time per byte,
+and it is only compared against the best seen for files of about the same size
+(within a factor of two). With the largest files scheduled first, the drop in file
+sizes over the run does not then read as congestion.
+
+A throttled key prefix is also backed off on its own, with exponential delay and
+jitter, since S3 throttles per prefix: the other prefixes keep going at full speed.
+"""
+
+WINDOW = 5.0
+DECREASE = 0.5
+LATENCY_RISE = 2.0
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+
+def size_class(nbytes):
+	"""
+	Files of the same class are within a factor of two in size
+	"""
+	return int(math.log(max(nbytes, 1), 2))
+
+
+def is_throttle(status, code=None):
+	"""
+	True for the S3 and HTTP responses that mean slow down
+	"""
+	return code == 'SlowDown' or status in ( 429, 503 )
+
+
+def key_prefix(key_name):
+	return os.path.dirname(key_name)
+
+
+class AdaptiveLimiter():
+
+	def __init__(self, logger, start, ceiling, floor=1, step=None):
+		self.ceiling = max(ceiling, 1)
+		self.floor = min(floor, self.ceiling)
+		self.limit = max(self.floor, min(start, self.ceiling))
+		self.step = step or max(1, self.limit // 4)
+		self.active = 0
+		self.cond = threading.Condition()
+		self.backoffs = {}
+
+		self.window_start = time.time()
+		self.window_bytes = 0
+		self.window_latency = {}		# size class: [ seconds per byte summed, transfers ]
+		self.window_saturated = False
+		self.window_throttled = False
+		self.last_rate = None
+		self.best_latency = {}			# size class: best window average of seconds per byte
+
+		# Hopefully we re-use the same logger here
+		self.logger = logging.getLogger(logger)
+		self.logger.info("Adaptive concurrency starting at %s slots, up to %s" % ( self.limit, self.ceiling ))
+
+	def acquire(self, error):
+		"""
+		Waits for a free slot, returns False if error is set while waiting
+		"""
+		with self.cond:
+			while self.active >= self.limit:
+				if error.is_set():
+					return False
+				self.cond.wait(1)
+
+			self.active += 1
+			if self.active >= self.limit:
+				self.window_saturated = True
+
+		return True
+
+	def release(self, nbytes, seconds):
+		"""
+		Hands back a slot after a transfer of nbytes that took seconds. Failed
+			transfers, nbytes unset, only count against throughput
+		"""
+		nbytes = int(nbytes or 0)
+
+		with self.cond:
+			self.active -= 1
+			self.window_bytes += nbytes
+
+			if nbytes:
+				sample = self.window_latency.setdefault(size_class(nbytes), [ 0.0, 0 ])
+				sample[0] += seconds / nbytes
+				sample[1] += 1
+
+			if time.time() - self.window_start >= WINDOW:
+				self.adjust()
+
+			self.cond.notify_all()
+
+	def throttled(self, key_name):
+		"""
+		Records a throttling response for key_name: backs its prefix off, and
+			halves the slots once per window
+		"""
+		prefix = key_prefix(key_name)
+
+		with self.cond:
+			delay = self.backoffs.get(prefix, ( 0, 0 ))[1]
+			delay = min(BACKOFF_MAX, max(BACKOFF_BASE, delay * 2))
+			self.backoffs[prefix] = ( time.time() + delay * random.uniform(0.5, 1.0), delay )
+
+			if not self.window_throttled:
+				self.window_throttled = True
+				self.set_limit( int(self.limit * DECREASE), "throttled on %s/" % prefix )
+
+	def succeeded(self, key_name):
+		prefix = key_prefix(key_name)
+
+		if prefix in self.backoffs:
+			with self.cond:
+				self.backoffs.pop(prefix, None)
+
+	def backoff(self, key_name, error):
+		"""
+		Sleeps until the prefix of key_name is no longer backed off
+		"""
+		until = self.backoffs.get(key_prefix(key_name), ( 0, 0 ))[0]
+
+		while not error.is_set() and time.time() < until:
+			time.sleep(min(1, until - time.time()))
+
+	def set_limit(self, limit, why):
+		limit = max(self.floor, min(limit, self.ceiling))
+
+		if limit != self.limit:
+			self.logger.info("Adaptive concurrency %s -> %s slots (%s)" % ( self.limit, limit, why ))
+			self.limit = limit
+
+	def adjust(self):
+		"""
+		End of window: takes the AIMD step and starts a new window. Called with cond held
+		"""
+		elapsed = time.time() - self.window_start
+		rate = self.window_bytes / elapsed
+
+		'''latency as a multiple of the best seen for the same file sizes'''
+		rise, count = 0.0, 0
+		for cls, ( per_byte, n ) in self.window_latency.items():
+			per_byte /= n
+			best = self.best_latency.get(cls)
+
+			if best is None or per_byte < best:
+				self.best_latency[cls] = best = per_byte
+
+			if best > 0:
+				rise += per_byte / best * n
+				count += n
+
+		rise = rise / count if count else 1.0
+
+		if self.window_throttled:
+			pass
+
+		elif self.last_rate is not None and rate < self.last_rate * 0.9 and rise > LATENCY_RISE:
+			self.set_limit( self.limit - self.step, "%.0f KB/s at %.1fx the best latency" % ( rate / 1024, rise ))
+
+		elif self.window_saturated:
+			self.set_limit( self.limit + self.step, "%.0f KB/s at %.1fx the best latency" % ( rate / 1024, rise ))
+
+		self.last_rate = rate
+		self.window_start = time.time()
+		self.window_bytes = 0
+		self.window_latency = {}
+		self.window_saturated = self.active >= self.limit
+		self.window_throttled = False
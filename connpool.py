@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+from boto.s3.connection import S3Connection
+import logging
+import os
+import threading
+import urllib3
+
+"""
+Process-wide connection pools for the upstream mirrors and S3, so the workers stop
+paying for a new TCP/TLS connection and a bucket validation request per file.
+
+Upstream HTTP goes through one urllib3 PoolManager shared by every thread. It keeps
+up to HTTP_PER_HOST keep-alive connections per host, and blocks for a free connection
+rather than opening more, so HTTP_PER_HOST is also the per-host cap. Dropped
+connections are detected and replaced by urllib3 before reuse.
+
+boto connections are not safe to share between threads, so each thread gets its own
+S3Connection per set of credentials, and keeps it. boto keeps the HTTP connections
+of an S3Connection alive and drops them once they have been idle too long. Buckets are
+looked up without validation; each bucket is validated once per process instead.
+
+Pools are not carried across a fork, a child process starts its own.
+"""
+
+HTTP_PER_HOST = 64
+HTTP_HOSTS = 10
+HTTP_TIMEOUT = urllib3.Timeout(connect=30, read=300)
+
+logger = logging.getLogger('_s3local_')
+
+_lock = threading.Lock()
+_http = None
+_http_pid = None
+_validated = set()
+_local = threading.local()
+
+
+def configure_http(per_host=HTTP_PER_HOST, hosts=HTTP_HOSTS):
+	"""
+	(Re)creates the upstream pool with per_host connections for each of up to hosts hosts
+	"""
+	global _http, _http_pid
+
+	with _lock:
+		if _http is not None and _http_pid == os.getpid():
+			_http.clear()
+
+		_http = urllib3.PoolManager(num_pools=hosts, maxsize=per_host, block=True, timeout=HTTP_TIMEOUT)
+		_http_pid = os.getpid()
+
+	return _http
+
+
+def http():
+	"""
+	The shared upstream PoolManager. Responses read with preload_content=False
+		must be handed back with release()
+	"""
+	if _http is None or _http_pid != os.getpid():
+		return configure_http()
+
+	return _http
+
+
+def release(resp):
+	"""
+	Returns the connection of a streamed response to the pool. A connection with
+		part of the body still unread can not be reused, so it is closed instead
+	"""
+	if not resp.closed:
+		resp.close()
+
+	resp.release_conn()
+
+
+def thread_state():
+	if getattr(_local, 'pid', None) != os.getpid():
+		_local.pid = os.getpid()
+		_local.conns = {}
+		_local.buckets = {}
+
+	return _local
+
+
+def s3_connection(creds):
+	"""
+	The calling thread's S3Connection for creds
+	"""
+	state = thread_state()
+	conn = state.conns.get(creds[0])
+
+	if conn is None:
+		conn = S3Connection( creds[0], creds[1] )
+		state.conns[creds[0]] = conn
+
+	return conn
+
+
+def s3_bucket(creds, name):
+	"""
+	The calling thread's Bucket name for creds. The first lookup of a bucket in the
+		process validates it, raising NO_BUCKET if it does not exist
+	"""
+	state = thread_state()
+	bucket = state.buckets.get(( creds[0], name ))
+
+	if bucket is not None:
+		return bucket
+
+	conn = s3_connection(creds)
+
+	with _lock:
+		validate = name not in _validated
+		_validated.add(name)
+
+	if validate and conn.lookup(name) is None:
+		with _lock:
+			_validated.discard(name)
+		raise Exception("NO_BUCKET", "Unable to get bucket %s" % name)
+
+	bucket = conn.get_bucket( name, validate=False )
+	state.buckets[( creds[0], name )] = bucket
+	return bucket
+
+
+def reset_s3():
+	"""
+	Drops the calling thread's S3 connections, i.e. after a connection error
+	"""
+	state = thread_state()
+
+	for conn in state.conns.values():
+		try:
+			conn.close()
+		except Exception, e:
+			logger.debug("Error closing S3 connection: %s" % e)
+
+	state.conns = {}
+	state.buckets = {}
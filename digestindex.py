@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+from array import array
+import binascii
+import bisect
+import hashlib
+
+"""
+DigestIndex is a compact, in-memory alternative to the sqlite md5s table.
+
+Every key is stored as a fixed width record of the MD5 digest of its name followed
+by its binary ETag, 32 bytes in all, so two million keys take about 64 MB. Records
+are kept in 256 runs by the first byte of the digest, each run a sorted string that
+is searched with a binary search. Key names are not kept; purging re-lists the bucket and
+checks each key against the index instead.
+"""
+
+DIGEST_SIZE = 16
+RECORD_SIZE = DIGEST_SIZE * 2
+
+# ETags that are not a plain MD5 (i.e. multipart uploads) never match
+NO_ETAG = '\xff' * DIGEST_SIZE
+
+
+def key_digest(name):
+	return hashlib.md5(name).digest()
+
+
+def etag_digest(etag):
+	etag = etag.replace('"', '')
+
+	if len(etag) != DIGEST_SIZE * 2:
+		return NO_ETAG
+
+	try:
+		return binascii.unhexlify(etag)
+	except TypeError:
+		return NO_ETAG
+
+
+class DigestIndex(object):
+
+	def __init__(self):
+		self.runs = [ bytearray() for i in range(256) ]
+		self.count = 0
+		self.data = None
+		self.offsets = None
+		self.found = None
+
+	def __len__(self):
+		if self.data is None:
+			return self.count
+
+		return self.offsets[-1]
+
+	def add(self, key_name, etag):
+		"""
+		Adds a key from the bucket listing. Call freeze() once all keys are added
+		"""
+		digest = key_digest(key_name)
+		self.runs[ord(digest[0])].extend(digest + etag_digest(etag))
+		self.count += 1
+
+	def freeze(self):
+		"""
+		Sorts the records of each run into one immutable string. One run is
+			unpacked at a time, so the extra memory needed is small
+		"""
+		self.data = []
+		self.offsets = array('L', [ 0 ])
+
+		for i in range(256):
+			run = self.runs[i]
+			records = [ str(run[n:n + RECORD_SIZE]) for n in xrange(0, len(run), RECORD_SIZE) ]
+			self.runs[i] = None
+			del run
+
+			records.sort()
+			self.data.append(''.join(records))
+			self.offsets.append(self.offsets[-1] + len(records))
+			del records
+
+		self.runs = None
+		self.found = bytearray(len(self))
+
+	def lookup(self, key_name):
+		"""
+		Returns the record number of key_name, or -1 if it is not in the index
+		"""
+		digest = key_digest(key_name)
+		run = ord(digest[0])
+		data = self.data[run]
+		lo = 0
+		hi = len(data) / RECORD_SIZE
+
+		while lo < hi:
+			mid = (lo + hi) // 2
+			start = mid * RECORD_SIZE
+			candidate = data[start:start + DIGEST_SIZE]
+
+			if candidate < digest:
+				lo = mid + 1
+			elif candidate > digest:
+				hi = mid
+			else:
+				return self.offsets[run] + mid
+
+		return -1
+
+	def etag(self, i):
+		run = bisect.bisect_right(self.offsets, i) - 1
+		start = ( i - self.offsets[run] ) * RECORD_SIZE + DIGEST_SIZE
+		return binascii.hexlify(self.data[run][start:start + DIGEST_SIZE])
+
+	def mark_found(self, i):
+		self.found[i] = 1
+
+	def is_orphaned(self, key_name):
+		"""
+		True if key_name was in the bucket listing but not referenced in the meta-data
+		"""
+		i = self.lookup(key_name)
+		return i >= 0 and not self.found[i]
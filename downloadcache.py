@@ -0,0 +1,225 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import logging
+import os
+import tempfile
+import threading
+import time
+
+"""
+DownloadCache is an on-disk, content-addressed cache of the pool files fetched from
+the mirror, so a restarted run (or the next one) uploads from local disk instead of
+fetching the same files again.
+
+Files are stored under the digest given for them by the Packages file, SHA256 when
+there is one and MD5 otherwise:
+
+	<dir>/sha256/ab/ab12...
+	<dir>/md5/cd/cd34...
+
+A file is written next to its final name while it streams through, and only renamed
+into place once the transfer has checked it against that digest, so the cache only
+ever holds good copies and can be shared by several processes. Hits touch the file,
+and the least recently used files are removed once the cache grows past max_bytes.
+"""
+
+# Keep evicting down to this share of max_bytes, so eviction does not run on every add
+EVICT_TO = 0.9
+
+# Files over this share of max_bytes are not cached
+MAX_FILE_SHARE = 0.25
+
+
+class CacheWriter():
+	"""
+	File object the transfer tees the fetched data into. commit() once the data
+		is verified, abort() otherwise
+	"""
+
+	def __init__(self, cache, fname):
+		self.cache = cache
+		self.fname = fname
+		self.size = 0
+
+		fh, self.temp_name = tempfile.mkstemp(prefix=".part-", dir=os.path.dirname(fname))
+		self.f = os.fdopen(fh, 'wb')
+
+	def write(self, data):
+		self.f.write(data)
+		self.size += len(data)
+
+	def commit(self):
+		self.f.close()
+		os.rename(self.temp_name, self.fname)
+		self.cache.added(self.fname, self.size)
+
+	def abort(self):
+		self.f.close()
+
+		try:
+			os.unlink(self.temp_name)
+		except OSError:
+			pass
+
+
+class DownloadCache():
+
+	def __init__(self, logger, cache_dir, max_bytes):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		self.evicting = False	# one thread walks the cache at a time
+		self.hits = 0
+		self.misses = 0
+
+		# Hopefully we re-use the same logger here
+		self.logger = logging.getLogger(logger)
+
+		for algo in ( 'sha256', 'md5' ):
+			if not os.path.isdir(os.path.join(cache_dir, algo)):
+				os.makedirs(os.path.join(cache_dir, algo))
+
+		self.total = sum([ size for mtime, size, fname in self.entries() ])
+		self.logger.info("Download cache %s holds %.1f of %.1f GB" % ( cache_dir,
+			self.total / 1073741824.0, max_bytes / 1073741824.0 ))
+
+		if self.total > max_bytes:
+			self.evict()
+
+	def path(self, sha256, md5):
+		"""
+		Cache file name for a file, or None if neither digest is known
+		"""
+		if sha256:
+			return os.path.join(self.cache_dir, 'sha256', sha256[:2], sha256)
+
+		if md5:
+			return os.path.join(self.cache_dir, 'md5', md5[:2], md5)
+
+		return None
+
+	def lookup(self, sha256, md5):
+		"""
+		Returns the cached file name, or None on a miss
+		"""
+		fname = self.path(sha256, md5)
+
+		if fname is not None and os.path.exists(fname):
+			try:
+				os.utime(fname, None)
+				self.hits += 1
+				return fname
+			except OSError:
+				'''evicted under us'''
+				pass
+
+		self.misses += 1
+		return None
+
+	def writer(self, sha256, md5, size=None):
+		"""
+		CacheWriter for a file about to be fetched, or None when it is not cached
+		"""
+		fname = self.path(sha256, md5)
+
+		if fname is None or ( size and int(size) > self.max_bytes * MAX_FILE_SHARE ):
+			return None
+
+		if not os.path.isdir(os.path.dirname(fname)):
+			try:
+				os.makedirs(os.path.dirname(fname))
+			except OSError:
+				'''made by another worker'''
+				pass
+
+		return CacheWriter(self, fname)
+
+	def discard(self, fname):
+		"""
+		Removes a cache file that turned out to be bad
+		"""
+		try:
+			size = os.path.getsize(fname)
+			os.unlink(fname)
+		except OSError:
+			return
+
+		self.logger.warn("Removed bad download cache file %s" % fname)
+		with self.lock:
+			self.total -= size
+
+	def added(self, fname, size):
+		with self.lock:
+			self.total += size
+			if self.total <= self.max_bytes or self.evicting:
+				return
+
+			self.evicting = True
+
+		try:
+			self.evict()
+		finally:
+			with self.lock:
+				self.evicting = False
+
+	def entries(self):
+		"""
+		Iterator over ( mtime, size, name ) of the cached files
+		"""
+		for algo in ( 'sha256', 'md5' ):
+			for dirpath, dirnames, filenames in os.walk(os.path.join(self.cache_dir, algo)):
+				for f in filenames:
+					fname = os.path.join(dirpath, f)
+
+					try:
+						st = os.stat(fname)
+					except OSError:
+						continue
+
+					if f.startswith('.part-') and st.st_mtime > time.time() - 86400:
+						'''still being written, maybe by another process'''
+						continue
+
+					yield st.st_mtime, st.st_size, fname
+
+	def evict(self):
+		"""
+		Removes the least recently used files down to EVICT_TO of max_bytes. The
+			sizes are re-read from disk, since other processes may share the
+			cache. The walk is done without the lock, so the workers can go on
+			adding files; it is only taken to update the total
+		"""
+		with self.lock:
+			counted = self.total
+
+		entries = sorted(self.entries())
+		target = self.max_bytes * EVICT_TO
+		removed = 0
+
+		with self.lock:
+			'''keep what was added during the walk, a file the walk also saw only evicts a bit early'''
+			self.total += sum([ size for mtime, size, fname in entries ]) - counted
+
+		for mtime, size, fname in entries:
+			with self.lock:
+				if self.total <= target:
+					break
+
+			try:
+				os.unlink(fname)
+			except OSError:
+				continue
+
+			with self.lock:
+				self.total -= size
+			removed += 1
+
+		self.logger.info("Evicted %s files from the download cache, %.1f GB left" % ( removed, self.total / 1073741824.0 ))
+
+	def report(self):
+		self.logger.info("Download cache: %s hits, %s misses" % ( self.hits, self.misses ))
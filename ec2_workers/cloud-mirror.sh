@@ -53,7 +53,7 @@ bzr branch lp:s3aptmirror /tmp/s3aptmirror
 
 	while /bin/true
 	do
-		python -OO apt2s3mirror --destination ${region}.ec2.archive.ubuntu.com --access_key ${ACCESS_KEY} --secret_key ${SECRET_KEY} --purge_old --delete_delay 3 --server archive.ubuntu.com
+		python -OO apt2s3mirror --destination ${region}.ec2.archive.ubuntu.com --access_key ${ACCESS_KEY} --secret_key ${SECRET_KEY} --purge_old --delete_delay 3 --server archive.ubuntu.com --cache_dir /mnt/apt2s3mirror-cache
 		error=$?
 
 		if [ ${error} -ne 3 -o ${error} -ne 0 ]; then
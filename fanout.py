@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+from fetchspill import encode_record, decode_record
+from s3uploadobj import S3UploadObject
+import logging
+import os
+import sqlite3
+
+"""
+Fan-out of one mirror run to several destination buckets: the meta-data is fetched
+and parsed once, each bucket is diffed on its own, and every file is downloaded once
+and uploaded to each bucket that needs it.
+
+FanoutWork collects the upload set of each bucket in a sqlite table, through
+collector(n), which stands in for the fetch queue of calc_pkg_work. items() then
+yields every file once, with the buckets needing it in its 'destinations' value.
+
+FanoutQueue stands in for the spool queue of the fetch stage, and hands each fetched
+file to the upload queue of every one of its destinations, sharing the spool file.
+"""
+
+COMMIT_EVERY = 10000
+
+
+class FanoutCollector():
+	"""
+	Queue-like upload set of destination dest
+	"""
+
+	def __init__(self, work, dest):
+		self.work = work
+		self.dest = dest
+
+	def put(self, item):
+		self.work.add(self.dest, item)
+
+
+class FanoutWork():
+
+	def __init__(self, logger, db_name):
+		self.db_name = db_name
+		self.db = sqlite3.connect(db_name)
+		self.db.execute("CREATE TABLE fanout (key_name TEXT, dest INTEGER, record TEXT)")
+		self.count = 0
+
+		# Hopefully we re-use the same logger here
+		self.logger = logging.getLogger(logger)
+
+	def collector(self, dest):
+		return FanoutCollector(self, dest)
+
+	def add(self, dest, item):
+		self.db.execute("INSERT INTO fanout VALUES (?, ?, ?)", ( item.get_value('key_name'), dest, encode_record(item) ))
+		self.count += 1
+
+		if self.count % COMMIT_EVERY == 0:
+			self.db.commit()
+
+	def items(self):
+		"""
+		Iterator over the files to upload, each once, with the list of its destinations
+		"""
+		self.db.commit()
+		files = 0
+
+		for key_name, dests, record in self.db.execute("""SELECT key_name, group_concat(dest), min(record)
+				FROM fanout GROUP BY key_name"""):
+			item = decode_record(record)
+			item.set_value('destinations', sorted([ int(d) for d in dests.split(',') ]))
+			files += 1
+			yield item
+
+		self.logger.info("Fanned %s uploads out of %s downloads" % ( self.count, files ))
+
+	def close(self):
+		self.db.close()
+		os.unlink(self.db_name)
+
+
+class FanoutQueue():
+	"""
+	Queue-like spool queue: put(( item, spool )) shares the spool between the upload
+		queues of the destinations of item
+	"""
+
+	def __init__(self, queues, pool):
+		self.queues = queues
+		self.pool = pool
+
+	def put(self, entry):
+		item, spool = entry
+		dests = item.get_value('destinations')
+
+		if spool is not None:
+			self.pool.share(spool, len(dests))
+
+		for d in dests:
+			self.queues[d].put(( item, spool ))
+
+
+def copy_item(item):
+	dup = S3UploadObject()
+	dup.__setstate__(item.__getstate__())
+
+	if item.extra is not None:
+		dup.extra = dict(item.extra)
+
+	return dup
+
+
+def copy_meta_batches(batches, suffix):
+	"""
+	Copies of the meta-data batches for one more destination. The meta workers
+		change the items and remove their cache files, so the copies get their
+		own items, and hard links to the cache files
+	"""
+	copies = []
+
+	for batch in batches:
+		dup_batch = []
+
+		for item in batch:
+			dup = copy_item(item)
+
+			if item.get_value('cache_file'):
+				link = "%s.%s" % ( item.get_value('cache_file'), suffix )
+				os.link(item.get_value('cache_file'), link)
+				dup.set_value('cache_file', link)
+
+			dup_batch.append(dup)
+
+		copies.append(dup_batch)
+
+	return copies
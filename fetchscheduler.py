@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import heapq
+import logging
+import Queue
+import time
+
+"""
+FetchScheduler stands in for the FIFO fetch queue between the bucket diff and the
+transfer workers, and hands out the queued items in the order of a list of policies:
+
+	largest		the biggest files first, so no big file starts late and stretches
+				the end of the run
+	fair		the dists take turns, so the updates of one dist do not wait for
+				all of another's
+	security	the files of the -security pockets first
+	fifo		the order of the Packages files, as before
+
+Later policies break the ties of earlier ones, i.e. 'security,largest'. The diff is
+streamed in, so items can only be ordered against the others queued at the time: the
+queue holds up to window items, and the diff blocks while it is full.
+
+The bytes of the queued items are kept count of, and progress() logs them with the
+rate the workers take them at, as an estimate of the time left.
+"""
+
+POLICIES = ( 'largest', 'fair', 'security', 'fifo' )
+WINDOW = 50000
+PROGRESS_EVERY = 60
+
+
+def item_size(item):
+	try:
+		return int(item.get_value('remote_size'))
+	except (TypeError, ValueError):
+		return 0
+
+
+class FetchScheduler(Queue.Queue):
+
+	def __init__(self, logger, policies=( 'largest', ), window=WINDOW):
+		Queue.Queue.__init__(self, window)
+
+		for policy in policies:
+			if policy not in POLICIES:
+				raise Exception("BAD_SCHEDULE", "Unknown fetch schedule policy %s, use %s" % ( policy, ", ".join(POLICIES) ))
+
+		self.policies = policies
+		self.seq = 0
+		self.dist_turns = {}
+
+		self.queued_bytes = 0
+		self.taken_bytes = 0
+		self.taken_files = 0
+		self.first_take = None
+		self.last_progress = time.time()
+
+		# Hopefully we re-use the same logger here
+		self.logger = logging.getLogger(logger)
+		self.logger.info("Fetch queue ordered by %s, over up to %s items" % ( ",".join(policies), window ))
+
+	def priority(self, item, size):
+		"""
+		Sort key of item, lowest first. Called with the mutex held
+		"""
+		key = []
+
+		for policy in self.policies:
+			if policy == 'largest':
+				key.append(-size)
+
+			elif policy == 'fair':
+				dist = item.get_value('dist')
+				self.dist_turns[dist] = self.dist_turns.get(dist, 0) + 1
+				key.append(self.dist_turns[dist])
+
+			elif policy == 'security':
+				key.append(not ( item.get_value('dist') or '' ).endswith('-security'))
+
+		return tuple(key)
+
+	# Queue.Queue storage, as in Queue.PriorityQueue; the mutex is held
+	def _init(self, maxsize):
+		self.queue = []
+
+	def _qsize(self, len=len):
+		return len(self.queue)
+
+	def _put(self, item):
+		size = item_size(item)
+		heapq.heappush(self.queue, ( self.priority(item, size), self.seq, size, item ))
+		self.seq += 1
+		self.queued_bytes += size
+
+	def _get(self):
+		key, seq, size, item = heapq.heappop(self.queue)
+		self.queued_bytes -= size
+		self.taken_bytes += size
+		self.taken_files += 1
+
+		if self.first_take is None:
+			self.first_take = time.time()
+
+		return item
+
+	def remaining_bytes(self):
+		"""
+		Bytes of the items not handed out yet
+		"""
+		with self.mutex:
+			return self.queued_bytes
+
+	def progress(self, populated=None, force=False):
+		"""
+		Logs the work left, at most every PROGRESS_EVERY seconds. The time left is only
+			estimated once the whole diff is queued, i.e. populated is set
+		"""
+		if not force and time.time() - self.last_progress < PROGRESS_EVERY:
+			return
+
+		self.last_progress = time.time()
+
+		with self.mutex:
+			files, left = len(self.queue), self.queued_bytes
+			taken, start = self.taken_bytes, self.first_take
+
+		rate = 0
+		if start is not None and time.time() > start:
+			rate = taken / ( time.time() - start )
+
+		eta = "unknown"
+		if populated is not None and populated.is_set() and rate:
+			eta = "%.0f min" % ( left / rate / 60 )
+
+		self.logger.info("Fetch queue: %s files, %.1f MB left, taken at %.0f KB/s, ETA %s" % ( files,
+			left / 1048576.0, rate / 1024, eta ))
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+from s3uploadobj import S3UploadObject
+import os
+import sqlite3
+import threading
+
+"""
+Append-only spill files for the fetch queue. Each pool file is written as one
+line of tab separated fields, so the files can be written by the parser workers
+as they go and read back one item at a time.
+
+SeenKeys is the on-disk counterpart for checking items against each other, i.e. for
+duplicates, without holding every key name in memory.
+"""
+
+RECORD_FIELDS = ( 'key_name', 'remote_url', 'remote_size', 'remote_md5', 'remote_sha256', 'name', 'dist' )
+
+
+def encode_record(item):
+	values = []
+	for field in RECORD_FIELDS:
+		value = item.get_value(field)
+
+		if value is None:
+			value = ''
+
+		elif '\t' in value or '\n' in value:
+			raise Exception("BAD_RECORD", "%s of %s can not be spilled" % ( field, item.get_value('key_name') ))
+
+		values.append(value)
+
+	return "%s\n" % '\t'.join(values)
+
+
+def decode_record(line):
+	item = S3UploadObject()
+
+	for field, value in zip(RECORD_FIELDS, line.rstrip('\n').split('\t')):
+		if value:
+			item.set_value(field, value)
+
+	return item
+
+
+def read_spill(fname):
+	"""
+	Iterator over the items in a spill file
+	"""
+	with open(fname, 'rb') as f:
+		for line in f:
+			yield decode_record(line)
+
+
+class FetchSpill():
+	"""
+	Writer for a spill file. It has the put() of a Queue, so it can be handed
+		to the parser workers in place of their fetch queue
+	"""
+
+	def __init__(self, fname):
+		self.fname = fname
+		self.count = 0
+		self.lock = threading.Lock()
+		self.f = open(fname, 'ab')
+
+	def put(self, item, block=True, timeout=None):
+		record = encode_record(item)
+
+		with self.lock:
+			self.f.write(record)
+			self.count += 1
+
+	def close(self):
+		with self.lock:
+			self.f.close()
+
+
+class SeenKeys():
+	"""
+	On-disk map of key names to the MD5 each was first added with, in a sqlite
+		file that is removed by close()
+	"""
+
+	def __init__(self, fname):
+		self.fname = fname
+		self.db = sqlite3.connect(fname)
+		self.db.execute("PRAGMA synchronous = OFF")
+		self.db.execute("PRAGMA journal_mode = OFF")
+		self.db.execute("CREATE TABLE IF NOT EXISTS seen (key_name TEXT PRIMARY KEY, md5 TEXT)")
+
+	def add(self, key_name, md5):
+		"""
+		Adds key_name, returns None if it is new, or else the MD5 it was first added with
+		"""
+		c = self.db.execute("INSERT OR IGNORE INTO seen VALUES (?, ?)", ( key_name, md5 ))
+		if c.rowcount:
+			return None
+
+		return self.get(key_name) or ''
+
+	def get(self, key_name):
+		row = self.db.execute("SELECT md5 FROM seen WHERE key_name = ?", ( key_name, )).fetchone()
+		if row is None:
+			return None
+
+		return row[0]
+
+	def close(self):
+		self.db.close()
+		os.unlink(self.fname)
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+"""
+Optional gevent transfer engine for apt2s3mirror.
+
+The transfer workers spend nearly all their time blocked on the network, so the
+thread count (--workers) caps throughput on directories full of small files. Python 2
+has no asyncio; gevent gives the same event loop model by patching socket, ssl, time,
+threading and Queue. With the patches in place the HTTP2S3Workers, boto and urllib3
+run unchanged as greenlets, and thousands of transfers can be in flight at once in
+one process.
+
+The patches have to be applied before anything else imports those modules, so
+apt2s3mirror checks its command line for --engine gevent before its other imports.
+gevent is only needed when the engine is used.
+"""
+
+try:
+	from gevent import monkey
+except ImportError:
+	monkey = None
+
+ENGINES = ( 'threads', 'gevent' )
+GREEN_WORKERS = 1000
+
+
+def requested(argv):
+	"""
+	True if the command line argv asks for the gevent engine
+	"""
+	for n, arg in enumerate(argv):
+		if arg == '--engine=gevent':
+			return True
+
+		if arg == '--engine' and argv[n + 1:n + 2] == [ 'gevent' ]:
+			return True
+
+	return False
+
+
+def patch():
+	if monkey is None:
+		raise SystemExit("The gevent engine needs the gevent module, see README.md")
+
+	monkey.patch_all()
+
+
+def patched():
+	return monkey is not None and monkey.is_module_patched('socket')
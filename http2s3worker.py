@@ -16,8 +16,17 @@ from boto.s3.key import Key
 from boto.s3.bucket import Bucket
 from boto.exception import S3CreateError, S3ResponseError, S3PermissionsError, S3DataError, BotoClientError, BotoServerError, StorageResponseError
 from s3uploadobj import S3UploadObject
+import concurrency
+import connpool
+import greenengine
+import rangefetch
+import base64
+import binascii
+import cStringIO
 import gc
+import hashlib
 import logging
+import mimetypes
 import os
 import Queue
 import time
@@ -25,9 +34,108 @@ import re
 import urllib3
 import time
 
+"""
+Remote files are streamed from the HTTP response straight into the S3 PUT, a buffer
+at a time, so a worker holds a few KB per file rather than the whole file. Files over
+the single PUT limit (or of unknown size) go up as a multipart upload instead, one part
+in memory at a time; PART_BUFFERS bounds how many parts all workers hold at once.
+"""
+
+MAX_SINGLE_PUT = 5 * 1024 * 1024 * 1024
+PART_SIZE = 16 * 1024 * 1024
+PART_BUFFERS = threading.BoundedSemaphore(4)
+
+# Object metadata holding the SHA256 of the file, x-amz-meta-sha256
+SHA256_META = 'sha256'
+
+def md5_pair(md5):
+	"""
+	( hex, base64 ) MD5 pair, as boto wants it, from a hex MD5
+	"""
+	return md5, base64.b64encode(binascii.unhexlify(md5))
+
+class DigestMismatch(Exception):
+	pass
+
+class HashingReader():
+	"""
+	Read-only file object over an HTTP response that hashes the data (MD5 and
+		SHA256) as it is read, so the bytes are only gone over once. The data
+		is also written to tee, i.e. a download cache file, when given
+
+	With expect, ( size, md5, sha256 ), the digests are checked as soon as the
+		last byte is read (size bytes, or the end of the response when the size
+		is unknown), and DigestMismatch is raised before that data is handed
+		on, so an upload reading from it is never completed with bad data
+	"""
+
+	def __init__(self, resp, tee=None, expect=None):
+		self.resp = resp
+		self.tee = tee
+		self.expect = expect
+		self.md5 = hashlib.md5()
+		self.sha256 = hashlib.sha256()
+		self.size = 0
+
+	def read(self, amt=None):
+		data = self.resp.read(amt, decode_content=False)
+		self.md5.update(data)
+		self.sha256.update(data)
+		self.size += len(data)
+
+		if self.expect is not None:
+			size = self.expect[0]
+			if ( size and self.size >= int(size) ) or not data:
+				self.verify()
+
+		if self.tee is not None:
+			self.tee.write(data)
+		return data
+
+	def verify(self):
+		size, md5, sha256 = self.expect
+		self.expect = None
+
+		if ( size and self.size != int(size) ) or ( md5 and self.hexdigest() != md5 ) or self.sha256_mismatch(sha256):
+			raise DigestMismatch("got %s bytes, MD5 %s, SHA256 %s, expected %s bytes, MD5 %s, SHA256 %s" % ( self.size,
+				self.hexdigest(), self.sha256.hexdigest(), size, md5, sha256 ))
+
+	def tell(self):
+		'''not seekable, boto leaves retries to us'''
+		raise IOError("stream is not seekable")
+
+	def hexdigest(self):
+		return self.md5.hexdigest()
+
+	def sha256_mismatch(self, sha256):
+		'''True if sha256 is known and the data read does not match it'''
+		return bool(sha256) and self.sha256.hexdigest() != sha256
+
+	def finish_tee(self, md5, sha256):
+		'''Keeps the tee'd copy if all of the data was read and checks out'''
+		if self.tee is None:
+			return
+
+		if self.hexdigest() == md5 and not self.sha256_mismatch(sha256):
+			self.tee.commit()
+		else:
+			self.tee.abort()
+
+class StatusKey(Key):
+	"""
+	Key that remembers the status of its last upload response. boto retries a 503
+		on its own, and then fails a streamed upload with a plain S3DataError
+	"""
+	last_status = None
+
+	def should_retry(self, response, chunked_transfer=False):
+		self.last_status = response.status
+		return Key.should_retry(self, response, chunked_transfer)
+
 class HTTP2S3Worker(threading.Thread):
 
-	def __init__(self, queue, dest_bucket, logger, creds, error, populated, max_retry=5, pre_checked=False):
+	def __init__(self, queue, dest_bucket, logger, creds, error, populated, max_retry=5, pre_checked=False, inventory=None,
+			pool=None, limiter=None, download_cache=None, mirrors=None, tempdir=None):
 		threading.Thread.__init__(self)
 		self.setDaemon(True)
 		self.queue = queue
@@ -37,24 +145,216 @@ class HTTP2S3Worker(threading.Thread):
 		self.error = error
 		self.populated = populated
 		self.max_retry = max_retry		# How many times to try and fetch the file
-		self.pre_checked = pre_checked	# Check the destination file for MD5 sum or not
+		self.pre_checked = pre_checked	# The diff already checked the bucket, trust it and the PUT ETag
+		self.inventory = inventory		# BucketInventory to record uploads in
+		self.pool = pool				# SpoolPool when fed ( item, spool ) by the fetch stage
+		self.limiter = limiter			# AdaptiveLimiter handing out transfer slots
+		self.download_cache = download_cache	# DownloadCache of fetched pool files
+		self.mirrors = mirrors			# MirrorPool of upstream mirrors to fetch from
+		self.tempdir = tempdir			# where files fetched in ranges are assembled
 
 		# Hopefully we re-use the same logger here
 		self.logger = logging.getLogger(logger)
 		self.logger.info("Worker thread created")
 
-	def reset_s3_connection(self):
-		self.logger.info("(re)Establishing S3 connection")
-		conn = S3Connection(self.creds[0], self.creds[1])
-		to_buck = conn.get_bucket(self.dest_bucket)
-		return conn, to_buck, 0
+	def s3_connection(self):
+		"""
+		The thread's pooled S3 connection and destination bucket
+		"""
+		return connpool.s3_connection(self.creds), connpool.s3_bucket(self.creds, self.dest_bucket)
+
+	def needs_upload(self, to_buck, rname, md5, sha256=None):
+		"""
+		HEADs rname (and its '+' variants) and returns False if they are all
+			in the bucket with the right MD5, or the right stored SHA256 (the
+			ETag of a multipart upload is not the MD5). Keys tagged for deletion
+			are untagged
+		"""
+		upload_stack = []
+		valid_keys = [ rname ]
+
+		if rname.find('+') > 0:
+			valid_keys.append(rname.replace('+',' '))
+			valid_keys.append(rname.replace('+','%2B'))
+
+		for r in valid_keys:
+			to_key = to_buck.get_key( r )
+			if to_key is not None and to_key.exists():
+				remote_etag = to_key.etag.replace('"','')
+				if remote_etag == md5 or ( sha256 and to_key.get_metadata(SHA256_META) == sha256 ):
+					if to_key.get_metadata("delete_ordinal"):
+						meta={}
+						meta['original_delete_ordinal'] = to_key.get_metadata("delete_ordinal")
+						if to_key.get_metadata(SHA256_META):
+							meta[SHA256_META] = to_key.get_metadata(SHA256_META)
+						to_key.copy( self.dest_bucket, r, metadata=meta, preserve_acl=True)
+						self.logger.info("Prevented %s from being deleted" % r)
+						if self.inventory:
+							self.inventory.record_tag( r, None )
+						upload_stack.append(False)
+
+					else:
+						upload_stack.append(False)
+
+				else:
+					self.logger.info("Re-uploading %s due to failed MD5" % r )
+					upload_stack.append(True)
+
+			else:
+				upload_stack.append(True)
+
+		return True in upload_stack
+
+	def note_throttle(self, rname, status, code=None):
+		"""
+		Tells the limiter about a SlowDown for rname
+		"""
+		if self.limiter and concurrency.is_throttle(status, code):
+			self.logger.info("Throttled (%s %s) on %s" % ( status, code, rname ))
+			self.limiter.throttled(rname)
+
+	def upstream(self, remote_url, headers=None):
+		"""
+		Opens remote_url, from a mirror picked by the MirrorPool when there is one.
+			Returns ( resp, mirror ), a failed request counts against the mirror
+		"""
+		if not self.mirrors:
+			return connpool.http().request('GET', remote_url, headers=headers, preload_content=False), None
+
+		mirror = self.mirrors.pick()
+		url, mirror_headers = self.mirrors.locate(mirror, remote_url)
+		mirror_headers.update(headers or {})
+
+		try:
+			resp = connpool.http().request('GET', url, headers=mirror_headers, preload_content=False)
+		except Exception:
+			self.mirrors.failed(mirror)
+			raise
+
+		if resp.status not in ( 200, 206 ):
+			self.mirrors.failed(mirror)
+
+		return resp, mirror
+
+	def fetch_ranged(self, remote_url, size, fname, md5, sha256):
+		"""
+		Downloads remote_url, of size bytes, into the file fname in parallel ranges
+			and checks it, keeping a copy in the download cache. Returns the
+			headers and the SHA256 of the file, or None if it does not check out
+		"""
+		open_url = lambda headers: self.upstream(remote_url, headers)[0]
+		fetch = rangefetch.RangeFetch('_s3local_', open_url, size, fname)
+		headers = fetch.run()
+
+		if headers is None:
+			self.logger.warn("Failed fetch of %s (%s)" % ( remote_url, fetch.status ))
+			return None
+
+		writer = None
+		if self.download_cache:
+			writer = self.download_cache.writer(sha256, md5, size)
+
+		got_md5, got_sha256 = rangefetch.file_digests(fname, tee=writer)
+		good = got_md5 == md5 and not ( sha256 and got_sha256 != sha256 )
+
+		if writer is not None and good:
+			writer.commit()
+		elif writer is not None:
+			writer.abort()
+
+		if not good:
+			self.logger.warn("Fetched ranges of %s do not check out - %s %s, %s %s" % ( remote_url, got_md5, md5, got_sha256, sha256 ))
+			return None
+
+		return headers, got_sha256
+
+	def put_ranged(self, to_buck, k, remote_url, size, md5, sha256):
+		"""
+		Uploads remote_url, fetched in parallel ranges into a temporary file. Returns
+			the ETag of the upload, or None if the file did not check out
+		"""
+		f = tempfile.NamedTemporaryFile(prefix="s3aptmirror-range-", dir=self.tempdir)
+
+		try:
+			fetched = self.fetch_ranged( remote_url, size, f.name, md5, sha256 )
+			if fetched is None:
+				return None
+
+			try:
+				k.set_metadata('Content-Type', fetched[0]['content-type'])
+			except KeyError:
+				pass
+
+			f.seek(0)
+			if size <= MAX_SINGLE_PUT:
+				k.set_contents_from_file( f, md5=md5_pair(md5), size=size )
+				return k.etag
+
+			return self.stream_multipart( to_buck, k, f )
+
+		finally:
+			f.close()
+
+	def put_cached(self, k, cached, md5):
+		"""
+		Uploads the download cache file cached. S3 checks it against Content-MD5,
+			a cache file that fails that is dropped from the cache
+		"""
+		size = os.path.getsize(cached)
+
+		try:
+			k.set_contents_from_filename( cached, md5=md5_pair(md5) )
+
+		except S3ResponseError, e:
+			if e.error_code in ( 'BadDigest', 'InvalidDigest' ):
+				self.download_cache.discard(cached)
+			raise
+
+		except S3DataError:
+			self.download_cache.discard(cached)
+			raise
+
+		return size
+
+	def stream_put(self, k, reader, size, md5):
+		"""
+		Single PUT of size bytes from reader. With the MD5 known up front boto does not
+			need to read the data twice, and S3 checks it against Content-MD5
+		"""
+		k.md5, k.base64md5 = md5_pair(md5)
+		k.size = size
+		k.send_file( reader, size=size )
+
+	def stream_multipart(self, to_buck, k, reader):
+		"""
+		Multipart upload from reader, PART_SIZE at a time. Returns the ETag of
+			the completed upload
+		"""
+		mp = to_buck.initiate_multipart_upload( k.name, metadata=k.metadata )
+		part_num = 0
+
+		try:
+			while True:
+				with PART_BUFFERS:
+					part = reader.read(PART_SIZE)
+					if not part and part_num > 0:
+						break
+
+					part_num += 1
+					mp.upload_part_from_file( cStringIO.StringIO(part), part_num )
+					del part
+
+			return mp.complete_upload().etag
+
+		except:
+			mp.cancel_upload()
+			raise
 
 	def run(self):
 		"""
 		This streams items over HTTP directly to S3 from a Queue comprising tuples of path and MD5 sum
 		"""
 		last_key = None
-		key_count = 0
 		to_buck = None
 		conn = None
 
@@ -71,22 +371,29 @@ class HTTP2S3Worker(threading.Thread):
 				break
 
 			if self.queue.empty():
+				if self.pool:
+					self.pool.note_upload_wait(2)
 				time.sleep(2)
 				continue
 
 
 			'''defend against queue race conditions'''
+			spool = None
 			try:
-				item = self.queue.get()
+				if self.pool:
+					item, spool = self.queue.get()
+				else:
+					item = self.queue.get()
+
 				name = item.get_value('key_name')				# the item name
 				last_key = name									# the last item worked on
 
 				md5 = item.get_value('remote_md5')				# md5 to compare with after writing
+				sha256 = item.get_value('remote_sha256')		# sha256 to check while streaming, and store
 				rname = item.get_value('key_name')				# s3 destination key name
 				remote_url = item.get_value('remote_url')	 	# remote URL of object
 				cache_file = item.get_value('cache_file')		# locale cache
 				content_type = item.get_value('content_type')	# Content type of local cache file
-				key_count += 1
 
 			except Queue.Empty, e:
 				if not self.populated.is_set():
@@ -104,91 +411,141 @@ class HTTP2S3Worker(threading.Thread):
 			finally:
 				pass
 
-			'''reset the key counter'''
-			if key_count > 90 or \
-				not conn or \
-				not to_buck:
-				conn, to_buck, key_count = self.reset_s3_connection()
+			slot = self.limiter is None or self.limiter.acquire(self.error)
+			started = time.time()
 
 			'''retry logic, yeah!'''
-			while tries <= self.max_retry and not success and name:
+			while slot and tries <= self.max_retry and not success and name:
 				try:
 
-					'''check if key exists first'''
 					tries += 1
-					upload_anyway = True
-					upload_stack = []
-					valid_keys = [ rname ]
 					resp = None
+					multipart = False
+					k = None
 
-					if rname.find('+') > 0:
-						valid_keys.append(rname.replace('+',' '))
-						valid_keys.append(rname.replace('+','%2B'))
-
-					for r in valid_keys:
-						to_key = to_buck.get_key( r )
-						if to_key is not None and to_key.exists():
-							remote_etag = to_key.etag.replace('"','')
-							if remote_etag == md5:
-								if to_key.get_metadata("delete_ordinal"):
-									meta={}
-									meta['original_delete_ordinal'] = to_key.get_metadata("delete_ordinal")
-									to_key.copy( self.dest_bucket, r, metadata=meta, preserve_acl=True)
-									self.logger.info("Prevented %s from being deleted" % r)
-									upload_stack.append(False)
-
-								else:
-									upload_stack.append(False)
+					if self.limiter:
+						self.limiter.backoff(rname, self.error)
 
-							else:
-								self.logger.info("Re-uploading %s due to failed MD5" % r )
-								upload_stack.append(True)
+					if not to_buck:
+						conn, to_buck = self.s3_connection()
 
-						else:
-							upload_stack.append(True)
-
-					if True not in upload_stack:
+					'''check if key exists first, unless the fetch stage or the diff did'''
+					if spool is None and not self.pre_checked and not self.needs_upload( to_buck, rname, md5, sha256 ):
 						success = True
 						continue
 
 					self.logger.info("[ %s/%s ] - Processing %s" % ( tries, self.max_retry, rname ))
 
-					k = Key(to_buck)
+					k = StatusKey(to_buck)
 					k.name = rname
 
-					if cache_file:
+					if sha256:
+						k.set_metadata(SHA256_META, sha256)
+
+					if spool is not None:
+						'''upload what the fetch stage spooled'''
+						if content_type:
+							k.set_metadata('Content-Type', content_type)
+						'''through a file of its own, the spool may be shared with other destinations'''
+						f = open(spool.name, 'rb')
+						try:
+							new_size = os.fstat(f.fileno()).st_size
+							k.set_contents_from_file( f, md5=md5_pair(md5), size=new_size )
+							new_etag = k.etag
+						finally:
+							f.close()
+
+					elif cache_file:
 						'''upload cached file'''
 						k.set_metadata('Content-Type', content_type)
 						k.set_contents_from_filename( cache_file )
+						new_size = os.path.getsize( cache_file )
+						new_etag = k.etag
+
+					elif self.download_cache and md5 and self.download_cache.lookup(sha256, md5):
+						'''upload from the download cache'''
+						k.set_metadata('Content-Type', mimetypes.guess_type(rname)[0] or 'application/octet-stream')
+						new_size = self.put_cached( k, self.download_cache.path(sha256, md5), md5 )
+						new_etag = k.etag
+
+					elif md5 and rangefetch.wanted(item.get_value('remote_size')):
+						'''big file, fetch it in parallel ranges'''
+						size = int(item.get_value('remote_size'))
+						new_etag = self.put_ranged( to_buck, k, remote_url, size, md5, sha256 )
+						if new_etag is None:
+							continue
+
+						multipart = size > MAX_SINGLE_PUT
+						new_size = size
 
 					else:
-						'''open remote URL and feed it to S3 directly'''
-						http = urllib3.PoolManager(1)
-						resp = http.request('GET', remote_url)
-
-						if resp.status == 200:
-							try:
-								k.set_metadata('Content-Type', resp.headers['content-type'])
-							except KeyError:
-								pass
-
-							k.set_contents_from_string( resp.data )
-							resp.release_conn()
-							del resp
-							del http
+						'''open remote URL and stream it to S3 directly'''
+						resp, mirror = self.upstream( remote_url )
+						fetch_start = time.time()
 
-						else:
+						if resp.status != 200:
 							self.logger.warn("[ %s/%s ] - Failed fetch of %s (%s) %s" % ( tries, self.max_retry, rname, resp.status, resp.headers ))
+							self.note_throttle( rname, resp.status )
+							connpool.release(resp)
 							continue
 
+						try:
+							k.set_metadata('Content-Type', resp.headers['content-type'])
+						except KeyError:
+							pass
+
+						size = item.get_value('remote_size')
+						writer = None
+						if self.download_cache and md5:
+							writer = self.download_cache.writer(sha256, md5, size)
+						'''checked before the last byte goes out, so a bad fetch never replaces the key'''
+						reader = HashingReader(resp, tee=writer, expect=( size, md5, sha256 ))
+						mismatch = False
+
+						try:
+							if md5 and size and int(size) <= MAX_SINGLE_PUT:
+								self.stream_put( k, reader, int(size), md5 )
+								new_etag = k.etag
+							else:
+								multipart = True
+								new_etag = self.stream_multipart( to_buck, k, reader )
+						except DigestMismatch, e:
+							self.logger.warn("[ %s/%s ] - Fetched digest mismatch for %s, not uploaded - %s" % ( tries, self.max_retry, rname, e ))
+							mismatch = True
+						except urllib3.exceptions.HTTPError:
+							if mirror:
+								self.mirrors.failed(mirror)
+							raise
+						finally:
+							connpool.release(resp)
+							reader.finish_tee( md5, sha256 )
+							del resp
+
+						if mismatch:
+							if mirror:
+								self.mirrors.failed(mirror)
+							continue
+
+						new_size = reader.size
+						if mirror:
+							self.mirrors.done( mirror, reader.size, time.time() - fetch_start )
+
 					k.close()
-					del k
 
-					'''Check the work, since we streamed the bits'''
-					upped_key = to_buck.get_key( rname )
-					new_etag = upped_key.etag.replace('"','')
-					upped_key.close()
-					if new_etag != md5:
+					if self.pre_checked:
+						'''the PUT returned the ETag, and boto checked it against the MD5 sent'''
+						new_etag = ( new_etag or '' ).replace('"','')
+
+					else:
+						'''Check the work, since we streamed the bits'''
+						upped_key = to_buck.get_key( rname )
+						new_etag = upped_key.etag.replace('"','')
+						new_size = upped_key.size
+						upped_key.close()
+						del upped_key
+
+					# the ETag of a multipart upload is not the MD5, the streamed MD5 was checked instead
+					if new_etag != md5 and not multipart:
 						self.logger.warn("[ %s/%s ] - MD5 mismatch for %s - %s %s" % ( tries, self.max_retry, rname, new_etag, md5 ))
 						continue
 
@@ -208,8 +565,13 @@ class HTTP2S3Worker(threading.Thread):
 
 						k1.close()
 
+					if self.inventory:
+						self.inventory.record_upload( rname, new_etag, new_size )
+
+					if self.limiter:
+						self.limiter.succeeded(rname)
+
 					success = True
-					del upped_key
 					del new_etag
 
 				except S3CreateError, e:
@@ -219,23 +581,37 @@ class HTTP2S3Worker(threading.Thread):
 				except S3ResponseError, e:
 					self.logger.warn("Got a bad response from S3 for  %s" % name )
 					self.logger.warn(e)
+					self.note_throttle( rname, e.status, e.error_code )
 
 				except BotoClientError, e:
 					self.logger.warn("Encountered general boto client error %s" % e )
+					if k is not None:
+						self.note_throttle( rname, k.last_status )
 
 				except BotoServerError, e:
 					self.logger.warn("Encountered general boto server error %s" % e )
+					self.note_throttle( rname, e.status, e.error_code )
 
 				except StorageResponseError, e:
 					self.logger.warn("Encountered general boto storage error %s" % e )
 
 				except Exception, e:
 					self.logger.warn("Failed upload for %s %s" % ( last_key, e ))
+					connpool.reset_s3()
+					conn, to_buck = None, None
 
 				finally:
-					gc.collect()
+					if not greenengine.patched():
+						'''a full collection stalls every greenlet at once, leave it to the collector'''
+						gc.collect()
 					time.sleep(0.1)
 
+			if slot and self.limiter:
+				self.limiter.release( success and item.get_value('remote_size'), time.time() - started )
+
+			if spool is not None:
+				self.pool.put(spool)
+
 			if item:
 				self.queue.task_done()
 				del item
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from fetchspill import read_spill
+
+"""
+APTMetaCache keeps APT meta-data files, and the package lists parsed out of them,
+between runs. Entries are keyed on the key name and the MD5 listed in the Release file,
+so an entry is only reused while upstream has not changed the file.
+
+Entries used by a run are marked as synced once that run has uploaded everything,
+which lets the parser workers queue only the items that changed since then. The synced
+markers are kept per destination (bucket and sub directory), since each destination
+is synced on its own: an entry only counts as synced when it is for every destination
+of the run, so a destination new to the cache gets the full package lists.
+"""
+
+class APTMetaCache():
+
+	def __init__(self, logger, cache_dir, destinations=None):
+		self.cache_dir = cache_dir
+		self.used = []		# (key_name, md5) of the entries used in this run
+
+		# extensions of the synced markers, one per "bucket/subdir" destination
+		self.synced_exts = [ "synced-%s" % hashlib.md5(d).hexdigest() for d in destinations or [ '' ] ]
+
+		# Hopefully we re-use the same logger here
+		self.logger = logging.getLogger(logger)
+
+		if not os.path.isdir(self.cache_dir):
+			os.makedirs(self.cache_dir)
+
+		self.logger.info("Using %s as meta-data cache" % self.cache_dir)
+
+	def entry_name(self, key_name, md5, ext):
+		m = hashlib.md5()
+		m.update(key_name)
+		return os.path.join(self.cache_dir, "%s-%s.%s" % ( m.hexdigest(), md5, ext ))
+
+	def cached_md5s(self, key_name, ext):
+		"""
+		Returns the MD5s of the cached entries of key_name with extension ext
+		"""
+		md5s = []
+		for name in glob.glob(self.entry_name(key_name, '*', ext)):
+			md5s.append(os.path.basename(name).split('-', 1)[1].rsplit('.', 1)[0])
+
+		return md5s
+
+	def has_file(self, key_name, md5):
+		return md5 is not None and os.path.exists(self.entry_name(key_name, md5, 'meta'))
+
+	def has_items(self, key_name, md5):
+		return md5 is not None and os.path.exists(self.entry_name(key_name, md5, 'records'))
+
+	def fetch_file(self, key_name, md5, tempdir, prefix):
+		"""
+		Copies the cached meta-data file into tempdir, since the meta workers remove
+			their cache file once it has been uploaded. Returns the copy's name
+		"""
+		fh, fname = tempfile.mkstemp(prefix=prefix, dir=tempdir)
+		os.close(fh)
+		shutil.copyfile(self.entry_name(key_name, md5, 'meta'), fname)
+		return fname
+
+	def fetch_items(self, key_name, md5):
+		"""
+		Iterator over the S3UploadObjects parsed from the cached meta-data file
+		"""
+		return read_spill(self.entry_name(key_name, md5, 'records'))
+
+	def is_synced(self, key_name, md5):
+		"""
+		True if this version of key_name was synced to every destination
+		"""
+		if md5 is None:
+			return False
+
+		for ext in self.synced_exts:
+			if not os.path.exists(self.entry_name(key_name, md5, ext)):
+				return False
+
+		return True
+
+	def synced_items(self, key_name):
+		"""
+		Returns the parsed items of the last version of key_name synced to
+			every destination, or None
+		"""
+		md5s = set(self.cached_md5s(key_name, self.synced_exts[0]))
+		for ext in self.synced_exts[1:]:
+			md5s &= set(self.cached_md5s(key_name, ext))
+
+		for md5 in md5s:
+			if self.has_items(key_name, md5):
+				return self.fetch_items(key_name, md5)
+
+		return None
+
+	def mark_used(self, key_name, md5):
+		self.used.append(( key_name, md5 ))
+
+	def commit(self):
+		"""
+		Marks every entry used in this run as synced. Only call this once
+			the run has successfully uploaded all of its items
+		"""
+		count = 0
+		for key_name, md5 in self.used:
+			if self.has_file(key_name, md5):
+				for ext in self.synced_exts:
+					open(self.entry_name(key_name, md5, ext), 'w').close()
+				count += 1
+
+		self.used = []
+		self.logger.info("Marked %s meta-data cache entries as synced" % count)
+
+	def temp_name(self):
+		"""
+		Name for a temporary file in the cache, i.e. the records of a parse that store()
+			moves into place
+		"""
+		fh, fname = tempfile.mkstemp(prefix=".tmp-", dir=self.cache_dir)
+		os.close(fh)
+		return fname
+
+	def store(self, key_name, md5, cache_file, records=None):
+		"""
+		Stores a downloaded meta-data file, and optionally the file of its parsed
+			items written at temp_name(), replacing any older copy of the same key
+		"""
+		if md5 is None:
+			if records is not None:
+				os.unlink(records)
+			return
+
+		for old in glob.glob(self.entry_name(key_name, '*', '*')):
+			os.unlink(old)
+
+		def copy_file(f):
+			with open(cache_file, 'rb') as src:
+				shutil.copyfileobj(src, f)
+
+		self.write_atomic(self.entry_name(key_name, md5, 'meta'), copy_file)
+
+		if records is not None:
+			os.rename(records, self.entry_name(key_name, md5, 'records'))
+
+		self.mark_used(key_name, md5)
+		self.logger.debug("Cached %s with MD5 %s" % ( key_name, md5 ))
+
+	def write_atomic(self, fname, writer):
+		fh, tmp_name = tempfile.mkstemp(prefix=".tmp-", dir=self.cache_dir)
+
+		try:
+			f = os.fdopen(fh, 'wb')
+			writer(f)
+			f.close()
+			os.rename(tmp_name, fname)
+
+		except Exception:
+			if os.path.exists(tmp_name):
+				os.unlink(tmp_name)
+			raise
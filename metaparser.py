@@ -15,7 +15,10 @@ from boto.s3.key import Key
 from time import strftime
 from datetime import date, timedelta
 from s3uploadobj import S3UploadObject
+from fetchspill import FetchSpill, SeenKeys
 import argparse
+import base64
+import bz2
 import logging
 import gzip
 import hashlib
@@ -28,7 +31,143 @@ import tempfile
 import traceback
 import time
 import threading
-import urllib3
+import connpool
+import rangefetch
+
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
+
+CHUNK_SIZE = 1024 * 1024
+TRANSLATION_FETCHERS = 4		# concurrent translation file fetches per worker
+
+# Fields kept from each stanza; everything else (Description etc) is skipped
+PKG_FIELDS = frozenset(('Package', 'Filename', 'Size', 'MD5sum', 'SHA256'))
+SRC_FIELDS = frozenset(('Package', 'Directory', 'Files', 'Checksums-Sha256'))
+
+
+# Compressed index variants, cheapest first. xz needs backports.lzma on python2
+COMPRESSION_PREFERENCE = [ '.bz2', '.gz' ]
+if lzma is not None:
+	COMPRESSION_PREFERENCE.insert(0, '.xz')
+
+
+def split_compression(name):
+	"""
+	Splits a meta-data file name into its base name and compression extension
+	"""
+	for ext in '.xz', '.bz2', '.gz':
+		if name.endswith(ext):
+			return name[:-len(ext)], ext
+
+	return name, ''
+
+
+def open_compressed(path, name=None):
+	"""
+	Opens a (possibly) compressed file with the codec matching the extension
+		of name, which defaults to path
+	"""
+	ext = split_compression(name or path)[1]
+
+	if ext == '.xz':
+		if lzma is None:
+			raise Exception("NO_LZMA", "xz support requires the lzma module")
+		return lzma.LZMAFile(path, 'rb')
+
+	elif ext == '.bz2':
+		return bz2.BZ2File(path, 'rb')
+
+	elif ext == '.gz':
+		return gzip.open(path, 'rb')
+
+	return open(path, 'rb')
+
+
+def iter_lines(f, chunk_size=CHUNK_SIZE):
+	"""
+	Line iterator over a file object that reads it in fixed size chunks
+	"""
+	tail = ''
+
+	while True:
+		chunk = f.read(chunk_size)
+		if not chunk:
+			break
+
+		lines = (tail + chunk).split('\n')
+		tail = lines.pop()
+		for line in lines:
+			yield line
+
+	if tail:
+		yield tail
+
+
+def iter_stanzas(lines, fields):
+	"""
+	Streaming deb822 parser. Yields one dict per stanza (i.e. per package)
+		holding only the requested fields. Multi-line fields, like Files,
+		are returned as a list of their continuation lines.
+	"""
+	stanza = {}
+	current = None
+
+	for line in lines:
+		if line[:1] in (' ', '\t'):
+			if current is not None:
+				stanza[current].append(line.strip())
+			continue
+
+		line = line.rstrip()
+		if not line:
+			if stanza:
+				yield stanza
+				stanza = {}
+			current = None
+			continue
+
+		name, sep, value = line.partition(':')
+		current = None
+
+		if name in fields:
+			value = value.strip()
+			if value:
+				stanza[name] = value
+			else:
+				stanza[name] = []
+				current = name
+
+	if stanza:
+		yield stanza
+
+
+class ParsedItems():
+	"""
+	Queue-like sink for a parse with the meta-data cache: every item is written to
+		the records spill as it is parsed, and the items not in the last synced
+		version (previous, a SeenKeys) are also put on the fetch queue
+	"""
+
+	def __init__(self, fetch_queue, records, previous=None):
+		self.fetch_queue = fetch_queue
+		self.records = records
+		self.previous = previous
+		self.unchanged = 0
+
+	def put(self, item, block=True, timeout=None):
+		self.records.put(item)
+
+		if self.previous and self.previous.get(item.get_value('key_name')) == item.get_value('remote_md5'):
+			self.unchanged += 1
+			return
+
+		self.fetch_queue.put(item)
 
 
 class APTParserWorker(threading.Thread):
@@ -36,7 +175,8 @@ class APTParserWorker(threading.Thread):
 	Thread worker for parsing over a queue of URLs to get meta information for an APT repo
 	"""
 
-	def __init__(self, logger, work_queue, fetch_queue, meta_queue, tempdir, server, dstdir, error):
+	def __init__(self, logger, work_queue, fetch_queue, meta_queue, tempdir, server, dstdir, error, metacache=None,
+			changes_only=False):
 		threading.Thread.__init__(self)
 		self.server = server
 		self.dstdir = dstdir
@@ -46,6 +186,9 @@ class APTParserWorker(threading.Thread):
 		self.work_queue = work_queue
 		self.fetch_queue = fetch_queue	# return queue for regular debs
 		self.meta_queue = meta_queue	# return queue for meta-data
+		self.metacache = metacache		# APTMetaCache of meta-data from previous runs
+		self.changes_only = changes_only	# only queue items changed since the last synced run
+		self.http = connpool.http()		# process-wide upstream pool
 
         # Hopefully we re-use the same logger here
 		self.logger = logging.getLogger(logger)
@@ -57,69 +200,52 @@ class APTParserWorker(threading.Thread):
 	def stopped(self):
 		return self._stop.isSet()
 
-	def decoder(self, gz_data):
+	def decoder(self, data, fname=None):
 		"""
-			Line iterator for a gzip object
+			Line iterator for a gzip, bz2 or xz file, read in chunks so that
+				the decompressed file is never held in memory in full. The
+				codec is picked from the extension of fname. A file that does
+				not decode raises, so that the parse fails rather than coming
+				up short
 		"""
 		f = None
 
 		try:
-			f = gzip.open(gz_data, 'rb')
-			for line in f.read().splitlines():
+			f = open_compressed(data, fname)
+			for line in iter_lines(f):
 				yield line
 
-		except Exception as e:
-			self.logger.debug(traceback.format_exc(e))
-			self.logger.debug("OH NOES!")
-
 		finally:
 			if f:
 				f.close()
 
 
-	def parse_src(self, gz_data, fetch_queue, fname):
-		src_re = re.compile('.*Source.*gz$')
-		src_pkg = re.compile('^Package:.*')				# New package header
-		src_files = re.compile('^Files:.*')				# Section header for source files
-		src_afiles = re.compile('.*dsc$|.*gz$')			# Actual files under section header for files
-		src_bfiles = re.compile('^.*:.*$')				# Next section match
-		src_dir = re.compile('^Directory:.*')			# Directory of the files
-
+	def parse_src(self, data, fetch_queue, fname):
 		count = 0
-		currpkg = None
-		currdir = None
-		currfile = None
-		reset = False
 
 		try:
 
-			for line in self.decoder(gz_data):
-				if src_pkg.match( line ):
-					currpkg = str( line.split(' ')[1] ).rstrip()
-					currdir = None
-					currfile = None
-
-				elif currpkg and src_dir.match( line ):
-					currdir = str( line.split(' ')[1] ).rstrip()
-
-				elif currdir and src_files.match( line ):
-					currfile = True
-
-				elif currfile:
-					if not src_bfiles.match( line ) and src_afiles.match( line ):
-						md5, size, pname = line.split()
-						s3obj  = S3UploadObject()
-						s3obj.set_value("name", pname )
-						s3obj.set_value("key_name", "%s/%s/%s" % ( self.dstdir, currdir, pname ))
-						s3obj.set_value("remote_url", "%s/%s/%s" % ( self.server, currdir, pname ))
-						s3obj.set_value("remote_md5", md5 )
-						s3obj.set_value("remote_size", size )
-						fetch_queue.put( s3obj )
-						count += 1
-					else:
-						currpkg = None
-						currdir = None
-						currfile = None
+			for stanza in iter_stanzas(self.decoder(data, fname), SRC_FIELDS):
+				currdir = stanza.get('Directory')
+				if not currdir:
+					continue
+
+				sha256s = {}
+				for entry in stanza.get('Checksums-Sha256') or []:
+					sha256, size, pname = entry.split()
+					sha256s[pname] = sha256
+
+				for entry in stanza.get('Files') or []:
+					md5, size, pname = entry.split()
+					s3obj  = S3UploadObject()
+					s3obj.set_value("name", pname )
+					s3obj.set_value("key_name", "%s/%s/%s" % ( self.dstdir, currdir, pname ))
+					s3obj.set_value("remote_url", "%s/%s/%s" % ( self.server, currdir, pname ))
+					s3obj.set_value("remote_md5", md5 )
+					s3obj.set_value("remote_size", size )
+					s3obj.set_value("remote_sha256", sha256s.get(pname) )
+					fetch_queue.put( s3obj )
+					count += 1
 
 			self.logger.info("Found %s items in %s" % (count, fname))
 
@@ -129,40 +255,27 @@ class APTParserWorker(threading.Thread):
 			return False
 
 
-	def parse_pkg(self, gz_data, fetch_queue, fname):
-		pkg_name = re.compile('^Package:.*')			# New package header
-		pkg_file = re.compile('^Filename:.*')			# File name of the packages
-		pkg_md5 = re.compile('^MD5sum:.*')				# MD5 of the package
-		pkg_size = re.compile('^Size:.*')				# Package size
-
-		reset = False
-		currpkg = None
-		currdir = None
-		currfile = None
+	def parse_pkg(self, data, fetch_queue, fname):
 		count = 0
 
 		try:
 
-			for line in self.decoder(gz_data):
+			for stanza in iter_stanzas(self.decoder(data, fname), PKG_FIELDS):
+				currfile = stanza.get('Filename')
+				currmd5 = stanza.get('MD5sum')
 
-				if pkg_name.match( line ):
-					currpkg = str( line.split(' ')[1] ).rstrip()
-
-				elif pkg_file.match( line ) and currpkg is not None:
-					currfile = str( line.split(' ')[1] ).rstrip()
-
-				elif pkg_size.match( line ) and currfile is not None:
-					currsize = str( line.split(' ')[1] ).rstrip()
+				if not currfile or not currmd5:
+					continue
 
-				elif pkg_md5.match( line ) and currsize is not None:
-					s3obj = S3UploadObject()
-					s3obj.set_value("name", currfile)
-					s3obj.set_value("key_name", "%s/%s" % ( self.dstdir, currfile ))
-					s3obj.set_value("remote_url", "%s/%s" % ( self.server, currfile ))
-					s3obj.set_value("remote_size", currsize )
-					s3obj.set_value("remote_md5", str( line.split(' ')[1] ).rstrip() )
-					fetch_queue.put( s3obj )
-					count += 1
+				s3obj = S3UploadObject()
+				s3obj.set_value("name", currfile)
+				s3obj.set_value("key_name", "%s/%s" % ( self.dstdir, currfile ))
+				s3obj.set_value("remote_url", "%s/%s" % ( self.server, currfile ))
+				s3obj.set_value("remote_size", stanza.get('Size') )
+				s3obj.set_value("remote_md5", currmd5 )
+				s3obj.set_value("remote_sha256", stanza.get('SHA256') )
+				fetch_queue.put( s3obj )
+				count += 1
 
 			self.logger.info("Found %s items in %s" % (count, fname))
 
@@ -171,47 +284,123 @@ class APTParserWorker(threading.Thread):
 			self.logger.info("Skipping file as a null file")
 			return False
 
-	def parse_int_index(self, data, meta_queue, fname):
-		skip = re.compile('^SHA1:$')
-		key_base = fname.replace('/Index','')
-		count = 0
-		tran = None
+	def fetch_translation(self, s3obj):
+		"""
+			Streams a translation file to disk, hashing it on the way through,
+				and checks it against the SHA1 from the i18n Index
+		"""
+		tran = self.http.request('GET', s3obj.get_value('remote_url'), retries=4, preload_content=False)
 
 		try:
-			for line in data.splitlines():
+			if tran.status != 200:
+				raise Exception("Failed fetch of %s (%s)" % ( s3obj.get_value('remote_url'), tran.status ))
 
-				if skip.match( line ):
-					continue
+			tran_fh, tran_cache = tempfile.mkstemp( prefix=s3obj.get_value('key_name').replace("/","_"), dir=self.tempdir)
+			s3obj.set_value("cache_file", tran_cache)
+			sha1 = hashlib.sha1()
+			md5 = hashlib.md5()
 
-				if len(line.split()) != 3:
-					continue
+			f_local = os.fdopen( tran_fh, "w+b" )
+			for chunk in tran.stream(CHUNK_SIZE):
+				f_local.write( chunk )
+				sha1.update( chunk )
+				md5.update( chunk )
+			f_local.close()
 
-				sha1, size, lname = line.split()
-				s3obj = S3UploadObject()
-				s3obj.set_value("name", lname)
-				s3obj.set_value("key_name", "%s/%s" % ( key_base, lname ))
-				s3obj.set_value("remote_url", "http://%s/%s/%s" % ( self.server, key_base, lname ))
-				s3obj.set_value("remote_size", size )
-				s3obj.set_value("remote_sha1", sha1 )
+			if sha1.hexdigest() != s3obj.get_value('remote_sha1'):
+				raise Exception("Corrupt SHA1 for %s (R) %s (L) %s" % ( s3obj.get_value('key_name'),
+					s3obj.get_value('remote_sha1'), sha1.hexdigest() ))
+
+			try:
+				s3obj.set_value('Content-Type', tran.headers['content-type'])
+			except KeyError:
+				pass
+
+			s3obj.set_md5_pair( md5.hexdigest(), base64.b64encode(md5.digest()) )
+
+		finally:
+			connpool.release(tran)
+
+	def fetch_ranged(self, url, size, fname):
+		"""
+			Fetches url, of size bytes, into fname in parallel ranges. Returns
+				( status, headers ), with the status of the first range when
+				the file is not on the server. The MD5 from the Release file
+				is checked by the caller
+		"""
+		open_url = lambda headers: self.http.request('GET', url, headers=headers, retries=4, preload_content=False)
+		fetch = rangefetch.RangeFetch('_s3local_', open_url, size, fname)
+		headers = fetch.run()
+
+		if headers is None:
+			return fetch.status, None
+
+		return 200, headers
 
-				http = urllib3.PoolManager()
-				tran = http.request('GET', s3obj.get_value('remote_url'), retries=4, preload_content=False)
-				tran_fh, tran_cache = tempfile.mkstemp( prefix=s3obj.get_value('key_name').replace("/","_"), dir=self.tempdir)
+	def parse_int_index(self, data, meta_queue, fname, url):
+		"""
+			Queues the translation files listed in an i18n Index. These are
+				fetched by TRANSLATION_FETCHERS threads through the shared
+				upstream connection pool
+		"""
+		sha1_re = re.compile('^SHA1:$')
+		key_base = fname.replace('/Index','')
+		url_base = url.replace('/Index','')
+		work = Queue.Queue()
+		errors = []
 
-				f_local = os.fdopen( tran_fh, "w+b" )
-				f_local.write( tran.data )
-				f_local.close()
+		def fetcher():
+			while not self.error.is_set() and not errors:
+				try:
+					s3obj = work.get_nowait()
+				except Queue.Empty:
+					return
 
 				try:
-					s3obj.set_value('Content-Type', tran.headers['content-type'])
-				except KeyError:
-					pass
+					self.fetch_translation( s3obj )
+					meta_queue.put( s3obj )
 
-				s3obj.set_value("cache_file", tran_cache)
-				s3obj.md5_cache_file()
+				except Exception, e:
+					errors.append( e )
+					self.logger.critical(traceback.format_exc(e))
 
-				count += 1
-				meta_queue.put( s3obj )
+		try:
+			in_sha1 = False
+			with open(data, 'rb') as f:
+				for line in f:
+
+					if sha1_re.match( line ):
+						in_sha1 = True
+						continue
+
+					elif not line.startswith(' '):
+						in_sha1 = False
+
+					if not in_sha1 or len(line.split()) != 3:
+						continue
+
+					sha1, size, lname = line.split()
+					s3obj = S3UploadObject()
+					s3obj.set_value("name", lname)
+					s3obj.set_value("key_name", "%s/%s" % ( key_base, lname ))
+					s3obj.set_value("remote_url", "%s/%s" % ( url_base, lname ))
+					s3obj.set_value("remote_size", size )
+					s3obj.set_value("remote_sha1", sha1 )
+					work.put( s3obj )
+
+			count = work.qsize()
+			threads = []
+			for n in range(min(TRANSLATION_FETCHERS, count)):
+				t = threading.Thread(target=fetcher, name="%s-i18n-%s" % ( self.name, n ))
+				t.daemon = True
+				t.start()
+				threads.append( t )
+
+			for t in threads:
+				t.join()
+
+			if errors:
+				raise errors[0]
 
 			self.logger.info("Found %s items in %s" % ( count, fname ))
 
@@ -221,17 +410,129 @@ class APTParserWorker(threading.Thread):
 			self.error.set()
 			raise
 
+	def parse_cached(self, parser, cache_file, fname):
+		"""
+			Runs parser and feeds its items to the fetch queue. When the meta-data
+				cache is in use, the items are also written to a records file as
+				they are parsed, and its name is returned so it can be cached.
+				Returns False if the parse failed
+		"""
+		if not self.metacache:
+			if parser(cache_file, self.fetch_queue, fname) is False:
+				return False
+			return None
+
+		previous = None
+		if self.changes_only:
+			synced = self.metacache.synced_items(fname)
+
+			if synced is not None:
+				fh, seen_name = tempfile.mkstemp(prefix="seen-", dir=self.tempdir)
+				os.close(fh)
+				previous = SeenKeys(seen_name)
+				for item in synced:
+					previous.add(item.get_value('key_name'), item.get_value('remote_md5'))
+
+		records = FetchSpill(self.metacache.temp_name())
+		parsed = ParsedItems(self.fetch_queue, records, previous)
+
+		try:
+			result = parser(cache_file, parsed, fname)
 		finally:
-			if tran:
-				tran.release_conn()
-				tran = None
+			records.close()
+			if previous is not None:
+				previous.close()
+
+		if previous is not None:
+			self.logger.info("Skipped %s items in %s unchanged since the last sync" % ( parsed.unchanged, fname ))
+
+		'''never cache the result of a failed parse'''
+		if result is False:
+			os.unlink(records.fname)
+			return False
+
+		return records.fname
+
+	def from_metacache(self, meta, pkg_re, src_re, index_re):
+		"""
+			Use the cached copy of the meta-data file when the MD5 in the Release
+				file matches it, skipping the fetch and the parse
+		"""
+		key_name = meta.get_value('key_name')
+		md5 = meta.get_value('remote_md5')
+		parse = meta.get_value('parse') and ( pkg_re.match(key_name) or src_re.match(key_name) )
+
+		if not self.metacache or not self.metacache.has_file(key_name, md5):
+			return False
+
+		'''the i18n Index queues more fetches when parsed, so it is never cached'''
+		if index_re.match(key_name):
+			return False
+
+		if parse and not self.metacache.has_items(key_name, md5):
+			return False
+
+		try:
+			meta.set_value("cache_file", self.metacache.fetch_file(key_name, md5, self.tempdir, meta.get_value('temp_name')))
+			meta.md5_cache_file()
+
+			if not meta.same("md5"):
+				self.logger.warn("Cached copy of %s is corrupt, fetching it again" % key_name)
+				os.unlink(meta.get_value('cache_file'))
+				return False
+
+			meta.set_value('size', str( os.stat(meta.get_value('cache_file'))[6] ))
+			meta.set_value('remote_size', meta.get_value('size'))
+
+			if parse and self.changes_only and self.metacache.is_synced(key_name, md5):
+				self.logger.info("Skipped all items in %s, unchanged since the last sync" % key_name)
+
+			elif parse:
+				count = 0
+				for item in self.metacache.fetch_items(key_name, md5):
+					self.fetch_queue.put(item)
+					count += 1
+
+				self.logger.info("Found %s cached items in %s" % (count, key_name))
+
+			self.metacache.mark_used(key_name, md5)
+
+		except Exception, e:
+			self.logger.warn("Unable to use cached copy of %s\n%s" % ( key_name, e ))
+			return False
+
+		self.logger.info("%s is unchanged, using cached copy" % key_name)
+		return True
+
+	def queue_variants(self, meta, parsed):
+		"""
+			Queues the other compressed variants of an index once its preferred
+				variant is done. If that one was to be parsed and was not (missing,
+				failed or not decodable), the next variant is parsed in its place.
+				With none left the dist's item list would be short, so it is fatal
+		"""
+		variants = meta.get_value('variants') or []
+		meta.set_value('variants', None)
+
+		if parsed:
+			for variant in variants:
+				self.work_queue.put(variant)
+			return
+
+		if not variants:
+			self.error.set()
+			raise Exception("META-ERROR", "No variant of %s could be parsed" % split_compression(meta.get_value('key_name'))[0])
+
+		self.logger.warn("Unable to parse %s, falling back to %s" % ( meta.get_value('key_name'), variants[0].get_value('key_name') ))
+		variants[0].set_value('parse', True)
+		variants[0].set_value('variants', variants[1:])
+		self.work_queue.put(variants[0])
 
 	def run(self):
 		key = Key()		# Use Boto for getting MD5 checksums
-		http = urllib3.PoolManager()
-		source_re = re.compile('.*(Sources,source).gz$')
-		pkg_re = re.compile('.*Packages.gz$')
-		src_re = re.compile('.*Source.*gz$')
+		http = self.http
+		pkg_re = re.compile('.*Packages\.(gz|bz2|xz)$')
+		src_re = re.compile('.*Sources\.(gz|bz2|xz)$')
 		index_re = re.compile('.*/i18n/Index$')
 
 		while not self.work_queue.empty() and not self.stopped() and not self.error.is_set():
@@ -256,34 +557,62 @@ class APTParserWorker(threading.Thread):
 				self.work_queue.task_done()
 				continue
 
+			if self.from_metacache( meta, pkg_re, src_re, index_re ):
+				self.meta_queue.put( meta )
+				self.queue_variants( meta, True )
+				self.work_queue.task_done()
+				continue
+
+			'''Packages and Sources yield the pool files, so they have to be parsed'''
+			parsed = not ( meta.get_value('parse') and ( pkg_re.match(meta.get_value('key_name')) or
+				src_re.match(meta.get_value('key_name')) ) )
+
 			while not success and tries < max_try:
 
 				tries += 1
 				self.logger.info("Attempt [ %s/%s ]: Fetching %s" % ( tries, max_try, meta.get_value('remote_url') ))
 				resp = None
+				fetched = False
+				ranged = rangefetch.wanted(meta.get_value('size'))
 
 				try:
 
-					resp = http.request('GET', meta.get_value('remote_url'), preload_content=False)
+					if ranged:
+						'''big files (Contents) come down in parallel ranges, straight into the cache file'''
+						meta_fh, meta_cache = tempfile.mkstemp( prefix=meta.get_value('temp_name'), dir=self.tempdir )
+						os.close(meta_fh)
+						status, headers = self.fetch_ranged(meta.get_value('remote_url'), meta.get_value('size'), meta_cache)
+						remote_size = meta.get_value('size')
+
+						if status != 200:
+							os.unlink(meta_cache)
 
-					if resp.status == 200:
+					else:
+						resp = http.request('GET', meta.get_value('remote_url'), preload_content=False)
+						status = resp.status
+
+					if status == 200:
 						'''only write the file if we get a good status code'''
-						meta_fh, meta_cache = tempfile.mkstemp( prefix=meta.get_value('temp_name'), dir=self.tempdir )
+						if not ranged:
+							meta_fh, meta_cache = tempfile.mkstemp( prefix=meta.get_value('temp_name'), dir=self.tempdir )
+							f_local = os.fdopen( meta_fh, "w+b" )
+							f_local.write( resp.data )
+							f_local.close()
+							remote_size = resp.headers['content-length']
+							headers = resp.headers
+
 						meta.set_value("cache_file", meta_cache)
 
 						try:
-							meta.set_value("Content-Type", resp.headers['content-type'])
+							meta.set_value("Content-Type", headers['content-type'])
 						except KeyError:
 							pass
 
-						f_local = os.fdopen( meta_fh, "w+b" )
-						f_local.write( resp.data )
-						f_local.close()
-
 						'''check the file'''
 						meta.set_value('size', str( os.stat(meta_cache)[6] ))
-						meta.set_value('remote_size', str( resp.headers['content-length'] ))
+						meta.set_value('remote_size', str( remote_size ))
 						meta.md5_cache_file()
+						fetched = meta.get_value('size') != '0'
 
 						if meta.get_value('remote_md5') and meta.get_value('md5'):
 							if not meta.same("md5"):
@@ -300,31 +629,42 @@ class APTParserWorker(threading.Thread):
 						else:
 							sucess = True
 
-					elif resp.status == 400 or resp.status == 404:
+					elif status == 400 or status == 404:
 						self.logger.warn("Attempt [ %s/%s ]: %s does not exist, excluding from set"  % ( tries, max_try, meta.get_value('remote_url') ))
 						remote_url_processing_done = True
 						success = True
 						continue
 
 					else:
-						self.logger.warn("Attempt [ %s/%s ]: %s received status %s"  % ( tries, max_try, meta.get_value('remote_url'), resp.status ))
+						self.logger.warn("Attempt [ %s/%s ]: %s received status %s"  % ( tries, max_try, meta.get_value('remote_url'), status ))
 
 
 					'''md5 the file'''
 					self.logger.info("MD5 of %s computed for %s" % ( meta.get_value('md5'), meta.get_value('key_name') ))
 
-					if resp.data:
+					'''only one compressed variant of each index is parsed'''
+					records = None
+					if fetched and meta.get_value('parse'):
 						if src_re.match(meta.get_value('key_name') ):
 							self.logger.info("Parsing %s as source meta-data" % meta.get_value('key_name'))
-							self.parse_src(meta_cache, self.fetch_queue, meta.get_value('key_name'))
+							records = self.parse_cached(self.parse_src, meta_cache, meta.get_value('key_name'))
 
 						elif pkg_re.match(meta.get_value('key_name') ):
 							self.logger.info("Parsing %s as package meta-data" % meta.get_value('key_name'))
-							self.parse_pkg(meta_cache, self.fetch_queue, meta.get_value('key_name'))
+							records = self.parse_cached(self.parse_pkg, meta_cache, meta.get_value('key_name'))
 
 						elif index_re.match(meta.get_value('key_name') ):
 							self.logger.info("Parsing %s as internationalization index file" % meta.get_value('key_name'))
-							self.parse_int_index(meta_cache, self.meta_queue, meta.get_value('key_name'))
+							self.parse_int_index(meta_cache, self.meta_queue, meta.get_value('key_name'), meta.get_value('remote_url'))
+
+					if self.metacache and success and fetched:
+						self.metacache.store(meta.get_value('key_name'), meta.get_value('remote_md5'),
+							meta_cache, records or None)
+					elif records:
+						os.unlink(records)
+
+					if fetched and records is not False:
+						parsed = True
 
 					self.meta_queue.put( meta )
 
@@ -336,6 +676,8 @@ class APTParserWorker(threading.Thread):
 
 				finally:
 					if resp:
-						resp.release_conn()
+						connpool.release(resp)
 						resp = None
 					self.work_queue.task_done()
+
+			self.queue_variants( meta, parsed )
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import connpool
+import hashlib
+import logging
+import random
+import socket
+import threading
+import time
+import urlparse
+
+"""
+MirrorPool spreads the pool file downloads over several upstream mirrors.
+
+The meta-data is always read from --server, which fixes the snapshot being mirrored.
+Before any file is downloaded, check() fetches the Release file of every dist from
+each mirror and drops the mirrors that do not serve the Release that was parsed,
+the way check-archive does. --server itself is checked the same way, since it may
+have been re-published since, or be a round-robin name. With resolve, a round-robin host name such as
+archive.ubuntu.com is resolved and each of its addresses is used, and checked, as a
+mirror of its own, with the Host header of the name.
+
+Downloads then pick a mirror at random, weighted by the throughput measured on it.
+Mirrors not measured yet are weighted as the fastest, so each one gets tried. A mirror
+that fails a download sits out for a back-off period that doubles with each failure
+in a row; the retry of the download goes to another mirror.
+"""
+
+# Weight of the latest transfer in the throughput average
+RATE_ALPHA = 0.2
+
+# Least weight of a slow mirror, as a share of the fastest, so it is still measured
+MIN_SHARE = 0.05
+
+BACKOFF_BASE = 5
+BACKOFF_MAX = 300
+
+
+class Mirror():
+
+	def __init__(self, base, host=None):
+		self.base = base.rstrip('/')
+		self.host = host			# Host header when base names an address
+		self.rate = None			# average bytes/second
+		self.failures = 0
+		self.until = 0				# out of use until
+
+	def __str__(self):
+		if self.host:
+			return "%s (%s)" % ( self.base, self.host )
+
+		return self.base
+
+
+def resolve(base):
+	"""
+	Mirrors for each IPv4 address of the host of the URL base
+	"""
+	url = urlparse.urlsplit(base)
+	port = url.port or 80
+
+	try:
+		addrs = sorted(set([ a[4][0] for a in socket.getaddrinfo(url.hostname, port, socket.AF_INET, socket.SOCK_STREAM) ]))
+	except socket.error:
+		return [ Mirror(base) ]
+
+	host = url.hostname
+	if url.port:
+		host = "%s:%s" % ( host, url.port )
+
+	mirrors = []
+	for addr in addrs:
+		netloc = addr
+		if url.port:
+			netloc = "%s:%s" % ( addr, url.port )
+		mirrors.append(Mirror(urlparse.urlunsplit(( url.scheme, netloc, url.path, '', '' )), host=host))
+
+	return mirrors
+
+
+class MirrorPool():
+
+	def __init__(self, logger, server, mirrors=(), resolve_hosts=False):
+		self.server = server.rstrip('/')
+		self.lock = threading.Lock()
+
+		# Hopefully we re-use the same logger here
+		self.logger = logging.getLogger(logger)
+
+		self.mirrors = []
+		for base in [ self.server ] + list(mirrors):
+			if resolve_hosts and base.startswith('http://'):
+				self.mirrors.extend(resolve(base))
+			else:
+				self.mirrors.append(Mirror(base))
+
+		self.logger.info("Upstream mirror pool: %s" % ", ".join([ str(m) for m in self.mirrors ]))
+
+	def __len__(self):
+		return len(self.mirrors)
+
+	def fetch(self, mirror, url):
+		"""
+		The body of url, under the server, from mirror, or None
+		"""
+		url, headers = self.locate(mirror, url)
+
+		try:
+			resp = connpool.http().request('GET', url, headers=headers, retries=2)
+		except Exception, e:
+			self.logger.warn("Unable to fetch %s from %s: %s" % ( url, mirror, e ))
+			return None
+
+		if resp.status != 200:
+			self.logger.warn("Unable to fetch %s from %s: %s" % ( url, mirror, resp.status ))
+			return None
+
+		return resp.data
+
+	def check(self, releases):
+		"""
+		Drops the mirrors whose Release files differ from the parsed ones, releases
+			maps each dist to the MD5 of its parsed Release
+		"""
+		consistent = []
+		for mirror in self.mirrors:
+			bad = []
+			for dist in sorted(releases):
+				data = self.fetch(mirror, "%s/dists/%s/Release" % ( self.server, dist ))
+				if data is None or hashlib.md5(data).hexdigest() != releases[dist]:
+					bad.append(dist)
+
+			if bad:
+				self.logger.warn("Not using mirror %s, out of sync with the meta-data parsed for %s" % ( mirror, ", ".join(bad) ))
+			else:
+				consistent.append(mirror)
+
+		if not consistent:
+			raise Exception("MIRROR_CHECK", "No upstream mirror is in sync with the meta-data parsed from %s" % self.server)
+
+		self.mirrors = consistent
+		self.logger.info("Using %s of the upstream mirrors" % len(consistent))
+
+	def locate(self, mirror, url):
+		"""
+		( url, headers ) to fetch url, a URL under the server, from mirror
+		"""
+		headers = {}
+
+		if mirror is not None and url.startswith(self.server):
+			url = mirror.base + url[len(self.server):]
+			if mirror.host:
+				headers['Host'] = mirror.host
+
+		return url, headers
+
+	def pick(self):
+		"""
+		A mirror chosen at random, weighted by throughput, from those not backed off
+		"""
+		now = time.time()
+
+		with self.lock:
+			live = [ m for m in self.mirrors if m.until <= now ]
+			if not live:
+				'''all of them failed lately, use the one back soonest'''
+				return min(self.mirrors, key=lambda m: m.until)
+
+			rates = [ m.rate for m in live if m.rate ]
+			fastest = max(rates or [ 1.0 ])
+			weights = [ max(m.rate or fastest, fastest * MIN_SHARE) for m in live ]
+
+		point = random.uniform(0, sum(weights))
+		for mirror, weight in zip(live, weights):
+			point -= weight
+			if point <= 0:
+				return mirror
+
+		return live[-1]
+
+	def done(self, mirror, nbytes, seconds):
+		"""
+		Records a good transfer of nbytes in seconds from mirror
+		"""
+		rate = nbytes / max(seconds, 0.001)
+
+		with self.lock:
+			if mirror.rate is None:
+				mirror.rate = rate
+			else:
+				mirror.rate += RATE_ALPHA * ( rate - mirror.rate )
+			mirror.failures = 0
+
+	def failed(self, mirror):
+		"""
+		Takes mirror out of use for a while after a failed transfer. Failures of
+			transfers started before it was taken out do not add to the back-off
+		"""
+		with self.lock:
+			if mirror.until > time.time():
+				return
+
+			mirror.failures += 1
+			delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** ( mirror.failures - 1 ))
+			mirror.until = time.time() + delay
+
+		self.logger.warn("Upstream mirror %s failed, not used for %ss" % ( mirror, delay ))
+
+	def report(self):
+		for mirror in self.mirrors:
+			self.logger.info("Upstream mirror %s: %.0f KB/s" % ( mirror, ( mirror.rate or 0 ) / 1024 ))
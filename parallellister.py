@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+from boto.s3.key import Key
+import connpool
+import logging
+import Queue
+import threading
+
+"""
+ParallelLister lists a bucket prefix as several shards at once and merges them back
+into a single stream in key order, i.e. the same stream bucket.list(prefix=...) gives.
+
+The keyspace is split on the '/' delimiter, a few levels down (ubuntu/pool/main/a/,
+ubuntu/pool/main/libx/, ubuntu/dists/trusty/, ...). Shards are disjoint and sorted,
+so merging is just reading them one after another. Workers list shards in order and
+run at most a bounded number of items ahead of the reader.
+"""
+
+DONE = object()
+
+class ParallelLister():
+
+	def __init__(self, creds, bucket_name, workers=8, max_depth=3, shard_target=None, logger='_s3local_',
+			queue_size=10000):
+		self.creds = creds
+		self.bucket_name = bucket_name
+		self.workers = max(1, workers)
+		self.max_depth = max_depth
+		self.shard_target = shard_target or self.workers * 4
+		self.queue_size = queue_size
+
+		# Hopefully we re-use the same logger here
+		self.logger = logging.getLogger(logger)
+
+	def get_bucket(self):
+		return connpool.s3_bucket( self.creds, self.bucket_name )
+
+	def shards(self, bucket, prefix):
+		"""
+		Splits prefix into a sorted list of ( name, key ) entries, where key is
+			either a Key listed while splitting or None for a prefix shard
+		"""
+		entries = [ ( prefix, None ) ]
+
+		for depth in range(self.max_depth):
+			prefixes = [ e for e in entries if e[1] is None ]
+
+			if len(prefixes) >= self.shard_target:
+				break
+
+			expanded = [ e for e in entries if e[1] is not None ]
+			for name, key in prefixes:
+				for item in bucket.list( prefix=name, delimiter='/' ):
+					if isinstance(item, Key):
+						expanded.append(( item.name, item ))
+					else:
+						expanded.append(( item.name, None ))
+
+			# a common prefix sorts where its keys would, so sorting on the name
+			# keeps the shards and the keys listed in between in key order
+			expanded.sort(key=lambda e: e[0])
+
+			if [ e[0] for e in expanded ] == [ e[0] for e in entries ]:
+				break
+
+			entries = expanded
+
+		return entries
+
+	def list(self, prefix=''):
+		"""
+		Iterator over the Keys under prefix, in key order
+		"""
+		bucket = self.get_bucket()
+		entries = self.shards(bucket, prefix)
+		shard_names = [ e[0] for e in entries if e[1] is None ]
+		self.logger.info("Listing %s in %s shards with %s workers" % ( prefix, len(shard_names), self.workers ))
+
+		work = Queue.Queue()
+		results = {}
+		for name in shard_names:
+			results[name] = Queue.Queue( maxsize=self.queue_size )
+			work.put( name )
+
+		stop = threading.Event()
+		threads = []
+
+		for n in range( min(self.workers, len(shard_names)) ):
+			t = threading.Thread( target=self.lister, args=( work, results, stop ), name="LIST-%s" % n )
+			t.daemon = True
+			t.start()
+			threads.append( t )
+
+		try:
+			for name, key in entries:
+				if key is not None:
+					yield key
+					continue
+
+				while True:
+					item = results[name].get()
+
+					if item is DONE:
+						break
+
+					elif isinstance(item, Exception):
+						raise item
+
+					yield item
+
+				del results[name]
+
+		finally:
+			stop.set()
+
+			for t in threads:
+				t.join()
+
+	def lister(self, work, results, stop):
+		"""
+		Worker thread: lists whole shards, in order, into their result queues
+		"""
+		bucket = None
+
+		while not stop.is_set():
+			try:
+				name = work.get_nowait()
+			except Queue.Empty:
+				return
+
+			try:
+				if bucket is None:
+					bucket = self.get_bucket()
+
+				for key in bucket.list( prefix=name ):
+					if not self.put( results[name], key, stop ):
+						return
+
+				self.put( results[name], DONE, stop )
+
+			except Exception, e:
+				self.logger.warn("Failed listing %s\n%s" % ( name, e ))
+				self.put( results[name], e, stop )
+				return
+
+	def put(self, queue, item, stop):
+		while not stop.is_set():
+			try:
+				queue.put( item, timeout=1 )
+				return True
+			except Queue.Full:
+				continue
+
+		return False
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import connpool
+import hashlib
+import logging
+import threading
+
+"""
+A few big files (Contents-*.gz, kernel, firmware and debug packages) hold up the end
+of a run when each comes down a single connection. Files of a size, known from the
+Packages or Release file, of RANGE_THRESHOLD or more are fetched as RANGE_SIZE byte
+ranges by RANGE_FETCHERS threads at once instead, each writing its ranges at their
+offset in a file of the full size.
+
+The ranges are not checked on their own beyond their length: once all of them are in,
+file_digests() hashes the assembled file to check it against the Packages or Release
+file before it goes any further.
+
+The first range is fetched alone, so a server that ignores Range and answers 200 has
+the whole file written out from that response, without the other ranges being asked,
+and a file that is not there (400 or 404) is reported by run() without retrying.
+"""
+
+CHUNK_SIZE = 1024 * 1024
+
+RANGE_THRESHOLD = 64 * 1024 * 1024
+RANGE_SIZE = 16 * 1024 * 1024
+RANGE_FETCHERS = 4
+RANGE_RETRIES = 3
+
+# Status of a file that is not on the server
+MISSING = ( 400, 404 )
+
+
+def wanted(size):
+	"""
+	True if a file of size, as given by the meta-data, is fetched in ranges
+	"""
+	try:
+		return int(size) >= RANGE_THRESHOLD
+	except (TypeError, ValueError):
+		return False
+
+
+def ranges(size, range_size=RANGE_SIZE):
+	"""
+	[ ( first, last ) ] byte ranges, inclusive, covering size bytes
+	"""
+	return [ ( start, min(start + range_size, size) - 1 ) for start in range(0, size, range_size) ]
+
+
+def file_digests(fname, tee=None):
+	"""
+	( md5, sha256 ) hex digests of the file fname, which is also written to tee when given
+	"""
+	md5 = hashlib.md5()
+	sha256 = hashlib.sha256()
+	f = open(fname, 'rb')
+
+	try:
+		while True:
+			data = f.read(CHUNK_SIZE)
+			if not data:
+				break
+			md5.update(data)
+			sha256.update(data)
+			if tee is not None:
+				tee.write(data)
+	finally:
+		f.close()
+
+	return md5.hexdigest(), sha256.hexdigest()
+
+
+class RangeFetch():
+
+	def __init__(self, logger, open_url, size, fname, fetchers=RANGE_FETCHERS):
+		"""
+		Download of size bytes into the existing file fname
+
+		logger: the logger to use
+		open_url: called with the request headers, returns the urllib3 response (not preloaded)
+		size: the size of the file, from the meta-data
+		fname: the file to write, it is cut or extended to size
+		fetchers: the number of ranges fetched at once
+		"""
+		self.open_url = open_url
+		self.size = int(size)
+		self.fname = fname
+		self.fetchers = fetchers
+		self.pending = ranges(self.size)
+		self.lock = threading.Lock()
+		self.failure = None
+		self.whole = False
+		self.status = None			# status of the first response
+
+		# Hopefully we re-use the same logger here
+		self.logger = logging.getLogger(logger)
+
+	def fetch_range(self, f, first, last):
+		"""
+		Writes bytes first to last at their offset in f, returns the response headers
+		"""
+		resp = self.open_url({ 'Range': 'bytes=%s-%s' % ( first, last ) })
+
+		try:
+			if first == 0:
+				self.status = resp.status
+
+			if resp.status in MISSING and first == 0:
+				return None
+
+			elif resp.status == 200 and first == 0:
+				'''Range ignored, this is the whole file'''
+				self.whole = True
+				last = self.size - 1
+
+			elif resp.status != 206:
+				raise Exception("RANGE_FETCH", "Failed fetch of bytes %s-%s of %s (%s)" % ( first, last, self.fname, resp.status ))
+
+			elif resp.headers.get('content-range') != "bytes %s-%s/%s" % ( first, last, self.size ):
+				raise Exception("RANGE_FETCH", "Got bytes %s for %s-%s/%s" % ( resp.headers.get('content-range'), first, last, self.size ))
+
+			got = 0
+			f.seek(first)
+			for data in resp.stream(CHUNK_SIZE, decode_content=False):
+				f.write(data)
+				got += len(data)
+
+			if got != last - first + 1:
+				raise Exception("RANGE_FETCH", "Short read of bytes %s-%s of %s, %s bytes" % ( first, last, self.fname, got ))
+
+			return resp.headers
+
+		finally:
+			connpool.release(resp)
+
+	def fetch_retried(self, f, first, last):
+		for tries in range(1, RANGE_RETRIES + 1):
+			try:
+				'''None, not on the server, is not retried either'''
+				return self.fetch_range(f, first, last)
+
+			except Exception, e:
+				self.logger.warn("[ %s/%s ] - Failed range %s-%s of %s: %s" % ( tries, RANGE_RETRIES, first, last, self.fname, e ))
+				if tries == RANGE_RETRIES:
+					raise
+
+	def next_range(self):
+		with self.lock:
+			if self.failure is None and self.pending:
+				return self.pending.pop(0)
+
+		return None
+
+	def fetcher(self):
+		f = open(self.fname, 'r+b')
+
+		try:
+			while True:
+				r = self.next_range()
+				if r is None:
+					break
+
+				self.fetch_retried(f, *r)
+
+		except Exception, e:
+			with self.lock:
+				if self.failure is None:
+					self.failure = e
+
+		finally:
+			f.close()
+
+	def run(self):
+		"""
+		Fetches the file, returns the headers of the first response, or None if the
+			file is not on the server (see status). Raises on failure
+		"""
+		f = open(self.fname, 'r+b')
+
+		try:
+			f.truncate(self.size)
+			headers = self.fetch_retried(f, *self.pending.pop(0))
+		finally:
+			f.close()
+
+		if headers is None:
+			return None
+
+		if self.whole:
+			self.logger.info("Range requests not served for %s, fetched it whole" % self.fname)
+			return headers
+
+		threads = []
+		for n in range(min(self.fetchers, len(self.pending))):
+			t = threading.Thread(target=self.fetcher)
+			t.daemon = True
+			t.start()
+			threads.append(t)
+
+		for t in threads:
+			t.join()
+
+		if self.failure is not None:
+			raise self.failure
+
+		return headers
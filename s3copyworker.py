@@ -3,6 +3,7 @@ from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 from boto.s3.bucket import Bucket
 import boto.exception
+import connpool
 import logging
 import Queue
 
@@ -17,10 +18,10 @@ class S3CopyWorker(threading.Thread):
 		self.max_tries = max_tries
 		threading.Thread.__init__(self)
 
-		self.connection = S3Connection(creds[0], creds[1])
+		self.creds = creds
 
 	def run(self):
-		from_buck = self.connection.get_bucket(self.src_bucket)
+		from_buck = connpool.s3_bucket(self.creds, self.src_bucket)
 		prestage = {}
 
 		'''bucket pool'''
@@ -43,7 +44,7 @@ class S3CopyWorker(threading.Thread):
 
 					try:
 						if to_buck not in bucket_pool:
-							bucket_pool[ to_buck ] = self.connection.get_bucket( to_buck )
+							bucket_pool[ to_buck ] = connpool.s3_bucket( self.creds, to_buck )
 
 					except boto.exception.AWSConnectionError, e:
 						self.logger.debug("Unable to establish connection to S3\n%s" % e )
@@ -13,31 +13,25 @@ import threading
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 from boto.s3.bucket import Bucket
+import connpool
 import logging
 import Queue
 
 class S3DeleteWorker(threading.Thread):
 
-	def __init__(self, queue, bucket, logger, creds, tname, silent=False):
+	def __init__(self, queue, bucket, logger, creds, tname, silent=False, inventory=None):
 		self.queue = queue
+		self.inventory = inventory
 		self.logger = logger
 		self.bucket = bucket
 		self.tname = tname
 		self.silent = silent
 		threading.Thread.__init__(self)
 
-		self.logger.debug("Initializing S3 Connection for %s" % self.tname)
-
-		try:
-			self.connection = S3Connection(creds[0], creds[1])
-		except Exception, e:
-			self.logger.error("Exception during establishment of S3 Connection")
-			self.logger.error(e)
-
-		self.logger.debug("S3 Connection established")
+		self.creds = creds
 
 	def run(self):
-		buck = self.connection.get_bucket( self.bucket )
+		buck = connpool.s3_bucket( self.creds, self.bucket )
 		self.logger.info("Deleteing files. Silent run: %s" % self.silent)
 
 		while not self.queue.empty():
@@ -49,6 +43,9 @@ class S3DeleteWorker(threading.Thread):
 					k = Key(buck)
 					k.key = name
 					k.delete()
+
+					if self.inventory:
+						self.inventory.record_delete( name )
 				except Exception, e:
 					self.logger.error("FAILED TO DELETE %s" % name)
 					self.logger.error(e)
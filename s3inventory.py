@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import connpool
+import csv
+import json
+import logging
+import os
+import time
+import urllib
+import zlib
+
+"""
+InventoryReport reads an S3 Inventory report, so that the keys of a large bucket can be
+seeded from the daily report instead of millions of LIST requests.
+
+The report is given by its manifest.json, either as a local path or as s3://bucket/key.
+Only CSV reports are read. The gzipped data files are decompressed and parsed as they
+are read, one row at a time, so memory stays flat however big the bucket is.
+
+For a local manifest the data files are looked up the way "aws s3 sync" lays out a
+report: <config>/data/<file> next to <config>/<date>/manifest.json, or else in the same
+directory as the manifest.
+"""
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def iter_gzip_lines(f, chunk_size=CHUNK_SIZE):
+	"""
+	Iterator over the lines of the gzip stream f, read chunk_size at a time
+	"""
+	d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	partial = ''
+	chunk = f.read(chunk_size)
+
+	while chunk:
+		data = d.decompress(chunk)
+
+		if d.unused_data:
+			# concatenated gzip members
+			data += d.flush()
+			chunk = d.unused_data
+			d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		else:
+			chunk = f.read(chunk_size)
+
+		lines = ( partial + data ).split('\n')
+		partial = lines.pop()
+
+		for line in lines:
+			yield line
+
+	lines = ( partial + d.flush() ).split('\n')
+	partial = lines.pop()
+
+	for line in lines:
+		yield line
+
+	if partial:
+		yield partial
+
+
+def under_prefixes(name, prefixes):
+	for prefix in prefixes:
+		if name.startswith(prefix):
+			return True
+
+	return False
+
+
+def seeded_listing(report, prefix, relist, lister):
+	"""
+	Iterator over ( name, etag, size ) under prefix, read from report except for the
+		relist prefixes, which are listed with lister( prefix ) instead. The
+		keys are not in key order
+	"""
+	relist = [ p for p in relist if p.startswith(prefix) ]
+
+	for name, etag, size in report.keys(prefix):
+		if not under_prefixes(name, relist):
+			yield name, etag, size
+
+	for p in relist:
+		for key in lister(p):
+			yield key
+
+
+def bucket_listing(lister, prefix, report=None, relist=()):
+	"""
+	Iterator over ( name, etag, size ) under prefix, listed with the ParallelLister
+		lister, or seeded from report when one is given
+	"""
+	def listed(p):
+		for key in lister.list(p):
+			yield key.name, key.etag.replace('"', ''), key.size
+
+	if report is None:
+		return listed(prefix)
+
+	return seeded_listing(report, prefix, relist, listed)
+
+
+class InventoryReport():
+
+	def __init__(self, logger, manifest, creds=None):
+		self.manifest = manifest
+		self.creds = creds
+
+		# Hopefully we re-use the same logger here
+		self.logger = logging.getLogger(logger)
+
+		f = self.open_manifest()
+		self.meta = json.load(f)
+		f.close()
+
+		if self.meta.get('fileFormat', 'CSV') != 'CSV':
+			raise Exception("INVENTORY_FORMAT", "Only CSV inventory reports can be read, not %s" % self.meta['fileFormat'])
+
+		self.source = self.meta.get('sourceBucket')
+		self.destination = self.meta.get('destinationBucket', '').split(':')[-1]
+		self.schema = [ s.strip() for s in self.meta['fileSchema'].split(',') ]
+		self.created = float(self.meta.get('creationTimestamp', 0)) / 1000
+
+		self.logger.info("Using inventory report of %s from %s (%s data files)" % ( self.source,
+			time.strftime('%Y-%m-%d %H:%M', time.gmtime(self.created)), len(self.meta['files']) ))
+
+	def age_days(self):
+		return ( time.time() - self.created ) / 86400
+
+	def open_key(self, bucket, key_name):
+		if self.creds is None:
+			raise Exception("NO_CREDENTIALS", "S3 Credentials needed to read %s" % self.manifest)
+
+		key = connpool.s3_bucket( self.creds, bucket ).get_key( key_name )
+
+		if key is None:
+			raise Exception("INVENTORY_MISSING", "s3://%s/%s does not exist" % ( bucket, key_name ))
+
+		return key
+
+	def open_manifest(self):
+		if self.manifest.startswith('s3://'):
+			bucket, key_name = self.manifest[5:].split('/', 1)
+			return self.open_key( bucket, key_name )
+
+		return open( self.manifest, 'rb' )
+
+	def open_data(self, key_name):
+		if self.manifest.startswith('s3://'):
+			return self.open_key( self.destination, key_name )
+
+		base = os.path.dirname( os.path.abspath(self.manifest) )
+		for fname in ( os.path.join(os.path.dirname(base), 'data', os.path.basename(key_name)),
+				os.path.join(base, os.path.basename(key_name)) ):
+			if os.path.exists(fname):
+				return open( fname, 'rb' )
+
+		raise Exception("INVENTORY_MISSING", "Data file %s of %s was not found" % ( key_name, self.manifest ))
+
+	def rows(self):
+		"""
+		Iterator over the rows of every data file, as dicts keyed by the schema
+		"""
+		for data in self.meta['files']:
+			self.logger.debug("Reading inventory data file %s" % data['key'])
+			f = self.open_data( data['key'] )
+
+			for row in csv.reader( iter_gzip_lines(f) ):
+				yield dict(zip(self.schema, row))
+
+			f.close()
+
+	def keys(self, prefix=''):
+		"""
+		Iterator over ( name, etag, size ) of the current keys under prefix
+		"""
+		count = 0
+
+		for row in self.rows():
+			if row.get('IsLatest', 'true') != 'true' or row.get('IsDeleteMarker', 'false') == 'true':
+				continue
+
+			name = urllib.unquote_plus( row['Key'] )
+			if not name.startswith(prefix):
+				continue
+
+			size = row.get('Size')
+			if size:
+				size = int(size)
+
+			count += 1
+			yield name, row.get('ETag', '').replace('"', ''), size
+
+		self.logger.info("Read %s keys under %s from the inventory report" % ( count, prefix ))
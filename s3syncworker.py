@@ -13,6 +13,7 @@ from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 from boto.s3.bucket import Bucket
 import boto.exception
+import connpool
 import logging
 import Queue
 import time
@@ -30,18 +31,10 @@ class S3SyncWorker(threading.Thread):
 		self.done_signal = done_signal
 		self.dest_bucket = dest_bucket
 
-		self.logger.debug("Initializing S3 Connection for %s" % self.name)
-
-		try:
-			self.connection = S3Connection(creds[0], creds[1])
-		except Exception, e:
-			self.logger.error("Exception during esatblishment of S3 Connection")
-			self.logger.error(e)
-
-		self.logger.debug("%s now has a S3 Connection" % self.name)
+		self.creds = creds
 
 	def run(self):
-		to_buck = self.connection.get_bucket( self.dest_bucket )
+		to_buck = connpool.s3_bucket( self.creds, self.dest_bucket )
 		self.logger.debug("%s found %s items in initial queue" % ( self.name, self.queue.qsize() ))
 		okay_to_die = False
 
@@ -12,9 +12,26 @@ from boto.s3.key import Key
 
 """
 S3UploadObject is a class that provides a way to describe an object for upload to S3
+
+There is one of these per pool file, so the standard attributes live in __slots__
+rather than a per-instance dict. Values outside of FIELDS are kept in a small dict
+that is only created when one is set.
 """
 
-class S3UploadObject():
+FIELDS = ( 'name', 'key_name', 'temp_name', 'cache_file', 'remote_url', 'md5', 'md5_encoded',
+	'remote_md5', 'remote_md5_encoded', 'size', 'remote_size', 'Content-Type',
+	'remote_sha1', 'remote_sha256', 'dist' )
+FIELD_SET = frozenset(FIELDS)
+
+# Value names that are not valid attribute names
+SLOT_NAMES = { 'Content-Type': 'content_type' }
+
+def slot_name(name):
+	return SLOT_NAMES.get(name, name)
+
+class S3UploadObject(object):
+
+	__slots__ = tuple([ slot_name(f) for f in FIELDS ]) + ( 'extra', )
 
 	def __init__(self, name=None, cache_file=None, remote_url=None, md5=None, md5_encoded=None,
 			remote_md5=None, remote_md5_encoded=None, size=None, temp_name=None, key_name=None, content_type=None):
@@ -22,68 +39,95 @@ class S3UploadObject():
 		"""
 		Standard attributes of a file destined for S3 upload
 		"""
-		self.obj = {}
-		self.obj['name'] = name
-		self.obj['key_name'] = key_name
-		self.obj['temp_name'] = temp_name
-		self.obj['cache_file'] = cache_file
-		self.obj['remote_url'] = remote_url
-		self.obj['md5'] = md5
-		self.obj['md5_encoded'] = md5_encoded
-		self.obj['remote_md5'] = remote_md5
-		self.obj['remote_md5_encoded'] = remote_md5_encoded
-		self.obj['size'] = size
-		self.obj['remote_size'] = size
-		self.obj['Content-Type'] = content_type
+		self.name = name
+		self.key_name = key_name
+		self.temp_name = temp_name
+		self.cache_file = cache_file
+		self.remote_url = remote_url
+		self.md5 = md5
+		self.md5_encoded = md5_encoded
+		self.remote_md5 = remote_md5
+		self.remote_md5_encoded = remote_md5_encoded
+		self.size = size
+		self.remote_size = size
+		self.content_type = content_type
+		self.remote_sha1 = None
+		self.remote_sha256 = None
+		self.dist = None
+		self.extra = None
+
+	def __getstate__(self):
+		return tuple([ getattr(self, s) for s in self.__slots__ ])
+
+	def __setstate__(self, state):
+		if isinstance(state, dict):
+			'''pickled by the older dict based object'''
+			self.__init__()
+			for name in state:
+				self.set_value(name, state[name])
+			return
+
+		for s, value in zip(self.__slots__, state):
+			setattr(self, s, value)
+
+	def has_value(self, name):
+		return name in FIELD_SET or ( self.extra is not None and name in self.extra )
 
 	def get_value(self, name):
 		"""
 		return values
 		"""
 
-		try:
-			return self.obj[name]
+		if name in FIELD_SET:
+			return getattr(self, slot_name(name))
+
+		if self.extra is not None:
+			return self.extra.get(name)
 
-		except KeyError, e:
-			return None
+		return None
 
 	def set_value(self, name, value):
-		self.obj[name] = value
+		if name in FIELD_SET:
+			setattr(self, slot_name(name), value)
+
+		else:
+			if self.extra is None:
+				self.extra = {}
+			self.extra[name] = value
 
 	def same(self, name):
 		"""
 		Compares local to remote values
 		"""
 
-		try:
-			if self.obj[name] == self.obj[ "remote_%s" % name ]:
-				return True
-			else:
-				return False
+		remote = "remote_%s" % name
 
-		except KeyError, e:
+		if not self.has_value(name) or not self.has_value(remote):
 			return False
 
+		return self.get_value(name) == self.get_value(remote)
+
 	def get_value_pairs(self, name):
 		"""
 		Returns local and remote values if set
 		"""
 
-		try:
-			return self.obj[name], self.obj["remote_%s" % name]
+		remote = "remote_%s" % name
 
-		except KeyError, e:
+		if not self.has_value(name) or not self.has_value(remote):
 			return False
 
+		return self.get_value(name), self.get_value(remote)
+
 	def set_md5_pair(self,md5, encoded):
 		"""
 		Set MD5 pair of hex and base64 encoded MD5 from a tuple)
 		"""
-		self.obj['md5'] = md5
-		self.obj['md5_encoded'] = encoded
+		self.md5 = md5
+		self.md5_encoded = encoded
 
 	def get_md5(self):
-		return self.obj['md5'], self.obj['md5_encoded']
+		return self.md5, self.md5_encoded
 
 	def md5_cache_file(self):
 		"""
@@ -92,11 +136,11 @@ class S3UploadObject():
 
 		key = Key()
 
-		if self.obj['cache_file']:
+		if self.cache_file:
 
-			fname = self.obj['cache_file']
+			fname = self.cache_file
 			f_open = open( fname )
-			self.obj['md5'], self.obj['md5_encoded'] = key.compute_md5( f_open )
+			self.md5, self.md5_encoded = key.compute_md5( f_open )
 			f_open.close()
 
 		else:
@@ -106,4 +150,11 @@ class S3UploadObject():
 		del key
 
 	def dump(self):
-		return self.obj
+		obj = {}
+		for name in FIELDS:
+			obj[name] = getattr(self, slot_name(name))
+
+		if self.extra is not None:
+			obj.update(self.extra)
+
+		return obj
@@ -0,0 +1,318 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+from http2s3worker import HTTP2S3Worker, HashingReader
+import connpool
+import rangefetch
+import hashlib
+import logging
+import Queue
+import tempfile
+import threading
+import time
+import urllib3
+
+"""
+Pipelined transfer of the fetch queue: HTTPFetchWorkers download files from the mirror
+into spool files, and HTTP2S3Workers upload the spooled files to S3. The two stages are
+joined by a SpoolPool, a fixed set of reusable spool files, so each side runs with its
+own number of workers and the downloads never get more than the pool ahead.
+
+A spool can be shared by several upload workers (one per destination bucket when
+fanning out), each reads it through its own file by name, and it is only reused once
+all of them have put it back.
+
+The pool keeps count of how long the fetch stage waited for a free spool (upload bound)
+and how long the upload stage waited for work (fetch bound), and logs both at the end.
+"""
+
+CHUNK_SIZE = 1024 * 1024
+
+class SpoolPool():
+
+	def __init__(self, logger, tempdir, count):
+		self.free = Queue.Queue()
+		self.spools = []
+		self.refs = {}
+		self.lock = threading.Lock()
+		self.fetch_wait = 0.0
+		self.upload_wait = 0.0
+		self.fetchers = 0
+		self.fetched = threading.Event()
+
+		# Hopefully we re-use the same logger here
+		self.logger = logging.getLogger(logger)
+
+		for n in range(count):
+			f = tempfile.NamedTemporaryFile(prefix="spool-", dir=tempdir)
+			self.spools.append(f)
+			self.free.put(f)
+
+	def get(self, error):
+		"""
+		Returns an empty spool file, waiting for one to be freed. Returns None
+			if error is set while waiting
+		"""
+		start = time.time()
+
+		while not error.is_set():
+			try:
+				f = self.free.get(timeout=1)
+			except Queue.Empty:
+				continue
+
+			with self.lock:
+				self.fetch_wait += time.time() - start
+
+			f.seek(0)
+			f.truncate()
+			return f
+
+		return None
+
+	def share(self, f, count):
+		'''f is handed to count upload workers, each will put it back'''
+		with self.lock:
+			self.refs[f.name] = count
+
+	def put(self, f):
+		with self.lock:
+			refs = self.refs.pop(f.name, 1) - 1
+			if refs > 0:
+				self.refs[f.name] = refs
+				return
+
+		self.free.put(f)
+
+	def note_upload_wait(self, seconds):
+		with self.lock:
+			self.upload_wait += seconds
+
+	def fetcher_started(self):
+		with self.lock:
+			self.fetchers += 1
+
+	def fetcher_done(self):
+		"""
+		Called by each exiting fetch worker, the last one marks the fetch stage done
+		"""
+		with self.lock:
+			self.fetchers -= 1
+			last = self.fetchers == 0
+
+		if last:
+			self.logger.info("Fetch stage finished: fetchers waited %.0fs for free spools (upload bound), "
+				"uploaders waited %.0fs for work (fetch bound)" % ( self.fetch_wait, self.upload_wait ))
+			self.fetched.set()
+
+	def close(self):
+		for f in self.spools:
+			f.close()
+
+class HTTPFetchWorker(HTTP2S3Worker):
+	"""
+	Fetch stage worker: checks the bucket for each item of queue, then downloads
+		the ones that need uploading into a spool and hands ( item, spool )
+		to the upload stage through spool_queue
+	"""
+
+	def __init__(self, queue, spool_queue, pool, dest_bucket, logger, creds, error, populated, max_retry=5,
+			pre_checked=False, inventory=None, download_cache=None, mirrors=None, tempdir=None):
+		HTTP2S3Worker.__init__(self, queue, dest_bucket, logger, creds, error, populated, max_retry=max_retry,
+			pre_checked=pre_checked, inventory=inventory, download_cache=download_cache, mirrors=mirrors,
+			tempdir=tempdir)
+		self.spool_queue = spool_queue
+		self.pool = pool
+		self.pool.fetcher_started()
+
+	def fetch_cached(self, cached, spool, md5):
+		"""
+		Copies the download cache file cached into spool, returns False (and drops
+			it from the cache) if it does not match md5
+		"""
+		m = hashlib.md5()
+		f = open(cached, 'rb')
+
+		try:
+			while True:
+				data = f.read(CHUNK_SIZE)
+				if not data:
+					break
+				m.update(data)
+				spool.write(data)
+		finally:
+			f.close()
+
+		spool.flush()
+
+		if m.hexdigest() != md5:
+			self.download_cache.discard(cached)
+			spool.seek(0)
+			spool.truncate()
+			return False
+
+		return True
+
+	def fetch_spool_ranged(self, item, spool):
+		"""
+		Downloads a big item into spool in parallel ranges, returns True if it checks out
+		"""
+		fetched = self.fetch_ranged( item.get_value('remote_url'), int(item.get_value('remote_size')), spool.name,
+			item.get_value('remote_md5'), item.get_value('remote_sha256') )
+		if fetched is None:
+			return False
+
+		headers, sha256 = fetched
+		if 'content-type' in headers:
+			item.set_value('content_type', headers['content-type'])
+
+		item.set_value('remote_sha256', sha256)
+		return True
+
+	def fetch(self, item, spool):
+		"""
+		Downloads item into spool, returns True if it arrived with the right MD5
+		"""
+		rname = item.get_value('key_name')
+		md5 = item.get_value('remote_md5')
+		sha256 = item.get_value('remote_sha256')
+		spool.seek(0)
+		spool.truncate()
+
+		if self.download_cache and md5:
+			cached = self.download_cache.lookup(sha256, md5)
+			if cached and self.fetch_cached(cached, spool, md5):
+				return True
+
+		if rangefetch.wanted(item.get_value('remote_size')):
+			return self.fetch_spool_ranged( item, spool )
+
+		resp, mirror = self.upstream( item.get_value('remote_url') )
+		fetch_start = time.time()
+
+		if resp.status != 200:
+			self.logger.warn("Failed fetch of %s (%s) %s" % ( rname, resp.status, resp.headers ))
+			connpool.release(resp)
+			return False
+
+		try:
+			item.set_value('content_type', resp.headers['content-type'])
+		except KeyError:
+			pass
+
+		writer = None
+		if self.download_cache and md5:
+			writer = self.download_cache.writer(sha256, md5, item.get_value('remote_size'))
+		reader = HashingReader(resp, tee=writer)
+
+		try:
+			while True:
+				data = reader.read(CHUNK_SIZE)
+				if not data:
+					break
+				spool.write(data)
+
+		except urllib3.exceptions.HTTPError:
+			if mirror:
+				self.mirrors.failed(mirror)
+			raise
+
+		finally:
+			connpool.release(resp)
+			reader.finish_tee( md5, sha256 )
+
+		spool.flush()
+
+		if reader.hexdigest() != md5:
+			self.logger.warn("Fetched MD5 mismatch for %s - %s %s" % ( rname, reader.hexdigest(), md5 ))
+			if mirror:
+				self.mirrors.failed(mirror)
+			return False
+
+		if reader.sha256_mismatch(sha256):
+			self.logger.warn("Fetched SHA256 mismatch for %s - %s %s" % ( rname, reader.sha256.hexdigest(), sha256 ))
+			if mirror:
+				self.mirrors.failed(mirror)
+			return False
+
+		if mirror:
+			self.mirrors.done( mirror, reader.size, time.time() - fetch_start )
+
+		'''hashed anyway, so the upload stage can store it'''
+		item.set_value('remote_sha256', reader.sha256.hexdigest())
+		return True
+
+	def run(self):
+		to_buck = None
+
+		try:
+			while not self.error.is_set():
+
+				if self.queue.empty() and \
+					self.populated.is_set():
+					self.logger.info("Nothing more to fetch.")
+					break
+
+				try:
+					item = self.queue.get(timeout=2)
+				except Queue.Empty:
+					continue
+
+				rname = item.get_value('key_name')
+
+				spool = None
+				success = False
+				checked = self.pre_checked
+				tries = 0
+
+				while tries <= self.max_retry and not success:
+					tries += 1
+
+					try:
+						if not to_buck:
+							conn, to_buck = self.s3_connection()
+
+						if item.get_value('cache_file'):
+							'''nothing to fetch, the upload stage reads the cache file'''
+							self.spool_queue.put(( item, None ))
+							success = True
+							continue
+
+						if not checked:
+							if not self.needs_upload( to_buck, rname, item.get_value('remote_md5'), item.get_value('remote_sha256') ):
+								success = True
+								continue
+							checked = True
+
+						if spool is None:
+							spool = self.pool.get( self.error )
+							if spool is None:
+								break
+
+						self.logger.info("[ %s/%s ] - Fetching %s" % ( tries, self.max_retry, rname ))
+						if self.fetch( item, spool ):
+							self.spool_queue.put(( item, spool ))
+							spool = None
+							success = True
+
+					except Exception, e:
+						self.logger.warn("Failed fetch for %s %s" % ( rname, e ))
+						connpool.reset_s3()
+						conn, to_buck = None, None
+						time.sleep(0.1)
+
+				if spool is not None:
+					self.pool.put(spool)
+
+				self.queue.task_done()
+
+				if not success:
+					self.logger.warn("Failed to fetch %s. Aborting upload to prevent inconsistent meta-data" % rname )
+					self.error.set()
+
+		finally:
+			self.pool.fetcher_done()
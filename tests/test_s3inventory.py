@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# vi: ts=4 noexpandtab
+
+## This comes with ABSOLUTELY NO WARRANTY; for details see COPYING.
+## This is free software, and you are welcome to redistribute it
+## under certain conditions; see copying for details.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from s3inventory import InventoryReport, seeded_listing
+
+"""
+Tests of the S3 Inventory report reader against the report in inventory/, laid out
+the way "aws s3 sync" leaves it: the manifest under its date, the data files under
+data/. The second data file is made of two gzip members.
+"""
+
+MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inventory', '2024-01-01T00-00Z', 'manifest.json')
+
+
+class InventoryReportTest(unittest.TestCase):
+
+	def setUp(self):
+		self.report = InventoryReport('_s3local_', MANIFEST)
+
+	def test_manifest(self):
+		self.assertEqual(self.report.source, 'mirror')
+		self.assertEqual(self.report.destination, 'mirror-inventory')
+		self.assertEqual(self.report.schema[1], 'Key')
+
+	def test_keys(self):
+		keys = dict([ ( name, ( etag, size ) ) for name, etag, size in self.report.keys() ])
+
+		self.assertEqual(keys['ubuntu/pool/main/a/apt/apt_1.0_amd64.deb'], ( '0a0a0a0a0a0a0a0a0a0a0a0a0a0a0a0a', 1000 ))
+		self.assertEqual(keys['debian/pool/main/a/apt/apt_1.0_amd64.deb'], ( '1a1a1a1a1a1a1a1a1a1a1a1a1a1a1a1a', 600 ))
+		self.assertEqual(len(keys), 5)
+
+	def test_url_decoded(self):
+		names = [ name for name, etag, size in self.report.keys() ]
+
+		self.assertTrue('ubuntu/pool/main/g/gcc/libstdc++6_4.8_amd64.deb' in names)
+		self.assertTrue('ubuntu/pool/main/s/space/with space_1.0_all.deb' in names)
+
+	def test_latest_only(self):
+		names = [ name for name, etag, size in self.report.keys() ]
+
+		self.assertFalse('ubuntu/pool/main/a/apt/apt_0.9_amd64.deb' in names)
+
+	def test_delete_marker(self):
+		names = [ name for name, etag, size in self.report.keys() ]
+
+		self.assertFalse('ubuntu/pool/main/d/deleted/deleted_1.0_all.deb' in names)
+
+	def test_prefix(self):
+		names = [ name for name, etag, size in self.report.keys('ubuntu/') ]
+
+		self.assertEqual(len(names), 4)
+		self.assertFalse([ n for n in names if not n.startswith('ubuntu/') ])
+
+
+class SeededListingTest(unittest.TestCase):
+
+	def setUp(self):
+		self.report = InventoryReport('_s3local_', MANIFEST)
+		self.listed = []
+
+	def lister(self, prefix):
+		self.listed.append(prefix)
+		yield '%sprecise/Release' % prefix, 'ffffffffffffffffffffffffffffffff', 401
+		yield '%sprecise/Release.gpg' % prefix, 'eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee', 198
+
+	def test_relisted(self):
+		keys = dict([ ( name, ( etag, size ) ) for name, etag, size in
+			seeded_listing(self.report, 'ubuntu/', [ 'ubuntu/dists/' ], self.lister) ])
+
+		self.assertEqual(self.listed, [ 'ubuntu/dists/' ])
+		self.assertEqual(keys['ubuntu/dists/precise/Release'], ( 'ffffffffffffffffffffffffffffffff', 401 ))
+		self.assertTrue('ubuntu/dists/precise/Release.gpg' in keys)
+		self.assertTrue('ubuntu/pool/main/g/gcc/libstdc++6_4.8_amd64.deb' in keys)
+		self.assertFalse('ubuntu/pool/main/a/apt/apt_0.9_amd64.deb' in keys)
+		self.assertFalse('ubuntu/pool/main/d/deleted/deleted_1.0_all.deb' in keys)
+		self.assertEqual(len(keys), 5)
+
+	def test_relist_outside_prefix(self):
+		keys = [ name for name, etag, size in seeded_listing(self.report, 'ubuntu/', [ 'debian/dists/' ], self.lister) ]
+
+		self.assertEqual(self.listed, [])
+		self.assertEqual(len(keys), 4)
+
+
+if __name__ == '__main__':
+	unittest.main()
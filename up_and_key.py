@@ -13,14 +13,14 @@ import sys
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 from boto.s3.bucket import Bucket
+import connpool
 import argparse
 import sys
 
 def upload(bucket, logs, remote_name, access_key, secret_key, valid_time):
 
 	try:
-		conn = S3Connection( access_key, secret_key )
-		bucket = conn.get_bucket( bucket )
+		bucket = connpool.s3_bucket( ( access_key, secret_key ), bucket )
 		key = Key( bucket )
 		key.name = remote_name
 		key.set_contents_from_filename( logs )